@@ -11,11 +11,16 @@ setup(name='uoa-groups',
           "openpyxl",
           "setuptools"
       ],
+      extras_require={
+          # uoa_groups.uoa_async
+          'async': ["trollius"]
+      },
       packages=find_packages(),
       license="GLPv3",
       entry_points={
           'console_scripts': [
-              'uoa-groups = uoa_groups.uoa_query:run'
+              'uoa-groups = uoa_groups.uoa_query:run',
+              'uoa-groups-complete = uoa_groups.uoa_complete:run'
           ],
       },
       description="Query UoA ldap and groups."
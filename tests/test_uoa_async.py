@@ -0,0 +1,126 @@
+'''
+Tests for uoa_async.uoa_ldap_async, run against uoa_fake_ldap.FakeLDAPObject.
+
+    python -m unittest discover -s tests
+'''
+
+import unittest
+import ldap
+from uoa_groups.uoa_async import uoa_ldap_async, asyncio
+from uoa_groups.uoa_fake_ldap import fake_connect, generate_population
+
+class AsyncClientTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.entries = generate_population(35)
+        self.upis = sorted(attrs['cn'][0] for attrs in self.entries.itervalues())
+        self.loop = asyncio.new_event_loop()
+        self.clients = []
+
+    def tearDown(self):
+
+        for client in self.clients:
+            client.close_ldap()
+        self.loop.close()
+
+    def client(self, latency=0.0, **kwargs):
+
+        client = uoa_ldap_async('user', 'password', loop=self.loop, poll_interval=0.01,
+                                connect=fake_connect(self.entries, latency=latency), **kwargs)
+        self.clients.append(client)
+        return client
+
+    def run_loop(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_find_upi(self):
+
+        client = self.client()
+
+        entry = self.run_loop(client.find_upi(self.upis[0]))
+        self.assertEqual(entry['cn'], [self.upis[0]])
+        self.assertIsNone(self.run_loop(client.find_upi('nobody')))
+
+    def test_find_upis(self):
+
+        client = self.client(latency=0.01)
+
+        entries = self.run_loop(client.find_upis([self.upis[0], 'nobody', self.upis[1]]))
+        self.assertEqual(entries[0]['cn'], [self.upis[0]])
+        self.assertIsNone(entries[1])
+        self.assertEqual(entries[2]['cn'], [self.upis[1]])
+
+    def test_paged_iteration(self):
+
+        client = self.client(pagesize=10)
+        bind_round_trips = client.ldap.round_trips
+
+        results = client.search('(cn=*)', ['cn'])
+        dns = []
+        while True:
+            try:
+                dn, attrs = self.run_loop(results.__anext__())
+            except StopIteration:
+                break
+            dns.append(dn)
+
+        self.assertEqual(dns, sorted(self.entries))
+        # 35 entries in pages of 10
+        self.assertEqual(client.ldap.round_trips - bind_round_trips, 4)
+
+    def test_collect(self):
+
+        client = self.client(pagesize=10)
+
+        results = self.run_loop(client.query_ldap('(cn=*)', ['cn']))
+        self.assertEqual(sorted(results), sorted(self.entries))
+
+    def test_search_user_scope(self):
+
+        client = self.client()
+        scopes = []
+        search_ext = client.ldap.search_ext
+
+        def recording_search_ext(base, scope, *args, **kwargs):
+            scopes.append(scope)
+            return search_ext(base, scope, *args, **kwargs)
+
+        client.ldap.search_ext = recording_search_ext
+        name = self.entries.values()[0]['displayName'][0]
+
+        results = self.run_loop(client.search_user(name))
+        self.assertEqual(sorted(results), sorted(dn for dn, attrs in self.entries.iteritems() if attrs['displayName'] == [name]))
+        # like uoa_ldap.search_user
+        self.assertEqual(scopes, [ldap.SCOPE_SUBTREE])
+
+    def test_max_concurrency(self):
+
+        client = self.client(latency=0.02, max_concurrency=2)
+        in_flight = []
+        # requests that were sent, but whose results weren't collected yet
+        client.ldap.on_request = lambda filterstr: in_flight.append(len(client.ldap._requests))
+
+        futures = [client.find_upi(upi) for upi in self.upis[:6]]
+        self.assertEqual(client._active, 2)
+        self.assertEqual(len(client._pending), 4)
+
+        entries = self.run_loop(asyncio.gather(*futures))
+        self.assertEqual([e['cn'][0] for e in entries], self.upis[:6])
+        self.assertEqual(len(in_flight), 6)
+        self.assertTrue(max(in_flight) < 2)
+        self.assertEqual(client._active, 0)
+
+    def test_timeout(self):
+
+        client = self.client(latency=1.0, timeout=0.05)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_loop(client.find_upi(self.upis[0]))
+
+        # the request was abandoned, and its slot released
+        self.assertEqual(client.ldap._requests, {})
+        self.assertEqual(client._active, 0)
+
+if __name__ == '__main__':
+    unittest.main()
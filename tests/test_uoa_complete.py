@@ -0,0 +1,58 @@
+'''
+Tests for uoa_complete, with completion files in a temporary folder.
+
+    python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from uoa_groups import uoa_complete
+
+class CompleteTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.table = os.path.join(self.folder, 'completion-groups')
+        self.recent_upis = os.path.join(self.folder, 'recent-upis')
+        uoa_complete._write_lines(self.table, sorted(['chem\tCHEM', 'chemistry\tCHEM', 'school of chemistry\tCHEM', 'sci\tSCI']))
+        for upi in ['abcd001', 'mbin029', 'abcd002']:
+            uoa_complete.remember_upi(upi, self.recent_upis)
+
+        # complete() uses the default files
+        self.complete_group = uoa_complete.complete_group
+        self.complete_upi = uoa_complete.complete_upi
+        uoa_complete.complete_group = lambda prefix: self.complete_group(prefix, self.table)
+        uoa_complete.complete_upi = lambda prefix: self.complete_upi(prefix, self.recent_upis)
+
+    def tearDown(self):
+
+        uoa_complete.complete_group = self.complete_group
+        uoa_complete.complete_upi = self.complete_upi
+        shutil.rmtree(self.folder)
+
+    def test_positional(self):
+
+        self.assertEqual(uoa_complete.complete('upi', 'upi', 'ab'), ['abcd001', 'abcd002'])
+        self.assertEqual(uoa_complete.complete('group', 'group', 'ch'), ['CHEM'])
+        self.assertEqual(uoa_complete.complete('group', 'group', 'sch'), ['CHEM'])
+
+    def test_after_flags(self):
+
+        self.assertEqual(uoa_complete.complete('upi', '-d', 'a'), ['abcd001', 'abcd002'])
+        self.assertEqual(uoa_complete.complete('upi', '--groups', 'mb'), ['mbin029'])
+        self.assertEqual(uoa_complete.complete('group', '--id', 'ch'), ['CHEM'])
+
+    def test_options(self):
+
+        self.assertEqual(uoa_complete.complete('search', '--in-unit', 'sci'), ['SCI'])
+        self.assertEqual(uoa_complete.complete('index', '-u', 'mb'), ['mbin029'])
+        self.assertEqual(uoa_complete.complete('index', '--members', 'chem'), ['CHEM'])
+        # options and positional arguments that aren't completed
+        self.assertEqual(uoa_complete.complete('search', 'search', 'ch'), [])
+        self.assertEqual(uoa_complete.complete('upi', 'upi', '-'), [])
+
+if __name__ == '__main__':
+    unittest.main()
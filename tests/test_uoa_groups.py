@@ -0,0 +1,147 @@
+'''
+Tests for reloading the UoA_groups hierarchy (reload, watch and diff_trees), with workbooks in a temporary folder.
+
+    python -m unittest discover -s tests
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from openpyxl import Workbook
+from uoa_groups.uoa_groups import UoA_groups, UoA_group, subtree_hashes, diff_trees
+
+HIERARCHY = [
+    ('UOA', 'SCI', 'Science', 'CHEM', 'Chemistry', None, None),
+    ('UOA', 'SCI', 'Science', 'PHYS', 'Physics', None, None),
+    ('UOA', 'SCI', 'Science', 'MATHS', 'Mathematics', 'MATHSA', 'Applied Mathematics'),
+    ('UOA', 'ART', 'Arts', 'HIST', 'History', None, None),
+    ('UOA', 'CER', 'eResearch', None, None, None, None)
+]
+
+# CHEM renamed, PHYS moved to ART, MATHSA removed, NESI added
+CHANGED_HIERARCHY = [
+    ('UOA', 'SCI', 'Science', 'CHEM', 'Chemical Sciences', None, None),
+    ('UOA', 'SCI', 'Science', 'MATHS', 'Mathematics', None, None),
+    ('UOA', 'ART', 'Arts', 'HIST', 'History', None, None),
+    ('UOA', 'ART', 'Arts', 'PHYS', 'Physics', None, None),
+    ('UOA', 'CER', 'eResearch', 'NESI', 'NeSI', None, None)
+]
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.excel_file = os.path.join(self.folder, 'departments.xlsx')
+        self.writes = 0
+        self.write_workbook(HIERARCHY)
+        self.groups = UoA_groups(self.excel_file)
+        self.diffs = []
+        self.groups.add_listener(lambda groups, diff: self.diffs.append(diff))
+
+    def tearDown(self):
+
+        self.groups.stop_watching()
+        shutil.rmtree(self.folder)
+
+    def write_workbook(self, rows):
+
+        wb = Workbook()
+        sheet = wb.active
+        sheet.title = 'Data'
+        sheet.append(['L1', 'L2', 'L2 desc', 'L3', 'L3 desc', 'L4', 'L4 desc', 'L5', 'L5 desc'])
+        for row in rows:
+            sheet.append(list(row))
+        wb.save(self.excel_file)
+        # the watcher looks at modification time and size, make sure it changes
+        self.writes += 1
+        mtime = int(time.time()) + self.writes
+        os.utime(self.excel_file, (mtime, mtime))
+
+    def test_unchanged(self):
+
+        self.write_workbook(HIERARCHY)
+        diff = self.groups.reload()
+
+        self.assertTrue(diff.is_empty())
+        self.assertEqual(self.diffs, [])
+
+    def test_reload(self):
+
+        old_root = self.groups.root
+        self.write_workbook(CHANGED_HIERARCHY)
+        diff = self.groups.reload()
+
+        self.assertEqual(diff.added, set(['NESI']))
+        self.assertEqual(diff.removed, set(['MATHSA']))
+        self.assertEqual(diff.renamed, {'CHEM': ('Chemistry', 'Chemical Sciences')})
+        self.assertEqual(diff.reparented, {'PHYS': ('SCI', 'ART')})
+        # PHYS (whose subtree is the same) and HIST are still valid
+        self.assertEqual(diff.invalidated, set(['UOA', 'SCI', 'CHEM', 'MATHS', 'MATHSA', 'ART', 'CER', 'NESI']))
+        self.assertEqual(self.diffs, [diff])
+
+        self.assertIsNot(self.groups.root, old_root)
+        self.assertEqual(self.groups.get_group('PHYS').parent.gid, 'ART')
+        self.assertEqual(self.groups.get_group('CHEM').name, 'Chemical Sciences')
+        self.assertIsNone(self.groups.get_group('MATHSA'))
+        self.assertEqual(self.groups.hashes, subtree_hashes(self.groups.root))
+        # the old version is left alone, for readers that still use it
+        self.assertEqual(old_root.get_child('PHYS', False).parent.gid, 'SCI')
+
+        self.write_workbook(HIERARCHY)
+        diff = self.groups.reload()
+        self.assertEqual(diff.added, set(['MATHSA']))
+        self.assertEqual(diff.removed, set(['NESI']))
+        self.assertEqual(diff.renamed, {'CHEM': ('Chemical Sciences', 'Chemistry')})
+        self.assertEqual(diff.reparented, {'PHYS': ('ART', 'SCI')})
+
+    def test_moved_subtree(self):
+
+        def tree(parent_of_maths):
+            root = UoA_group('UOA', 'University of Auckland')
+            for gid in ['SCI', 'ART']:
+                root.add_child(gid, gid.title())
+            root.get_child('SCI').add_child('PHYS', 'Physics')
+            root.get_child(parent_of_maths).add_child('MATHS', 'Mathematics')
+            root.get_child('MATHS').add_child('MATHSA', 'Applied Mathematics')
+            return root, subtree_hashes(root)
+
+        old_root, old_hashes = tree('SCI')
+        new_root, new_hashes = tree('ART')
+        diff = diff_trees(old_root, old_hashes, new_root, new_hashes)
+
+        # only the moved group is reported, not the unchanged groups below it
+        self.assertEqual(diff.reparented, {'MATHS': ('SCI', 'ART')})
+        self.assertEqual((diff.added, diff.removed, diff.renamed), (set(), set(), {}))
+        self.assertEqual(diff.invalidated, set(['UOA', 'SCI', 'ART']))
+
+    def test_failed_reload(self):
+
+        root = self.groups.root
+        with open(self.excel_file, 'wb') as f:
+            f.write('not a workbook')
+
+        with self.assertRaises(Exception):
+            self.groups.reload()
+        self.assertIs(self.groups.root, root)
+        self.assertEqual(self.diffs, [])
+
+    def test_watch(self):
+
+        reloaded = threading.Event()
+        self.groups.add_listener(lambda groups, diff: reloaded.set())
+        self.groups.watch(interval=0.05)
+
+        self.write_workbook(CHANGED_HIERARCHY)
+        self.assertTrue(reloaded.wait(10))
+        self.assertEqual(self.groups.get_group('PHYS').parent.gid, 'ART')
+
+        self.groups.stop_watching()
+        self.assertIsNone(self.groups._watcher)
+        self.assertEqual(len(self.diffs), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+Tests for uoa_people.PeopleIndex, refreshed from uoa_fake_ldap.
+
+    python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from uoa_groups.uoa_ldap import uoa_ldap
+from uoa_groups.uoa_people import PeopleIndex
+from uoa_groups.uoa_fake_ldap import fake_connect, generate_population
+
+class PeopleIndexTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.entries = generate_population(200)
+        self.dns = sorted(self.entries)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    def refresh(self, index, full=False):
+
+        return index.refresh(uoa_ldap('user', 'password', connect=fake_connect(self.entries)), full)
+
+    def test_incremental_refresh(self):
+
+        index = PeopleIndex()
+        self.assertEqual(self.refresh(index), (200, 0))
+
+        changed = self.entries[self.dns[0]]
+        self.entries[self.dns[0]] = dict(changed, sn=['Zyxwvut'], whenChanged=['20990101000000.0Z'])
+        removed = self.entries.pop(self.dns[1])['cn'][0]
+
+        self.assertEqual(self.refresh(index), (1, 1))
+        self.assertEqual(len(index), 199)
+        self.assertIsNone(index.get(removed))
+
+        # the replaced and the removed entry are skipped
+        results = index.search('zyxwvut')
+        self.assertEqual([entry['cn'][0] for score, entry in results], [changed['cn'][0]])
+        self.assertEqual(list(results[0][1]['sn']), ['Zyxwvut'])
+        self.assertEqual(index.search(changed['sn'][0], limit=500), self.search_all(index, changed['sn'][0]))
+
+    def search_all(self, index, query):
+        '''Searches the index without removed users, by rebuilding it from the remaining entries.'''
+
+        fresh = PeopleIndex()
+        for user_id in sorted(index.user_ids.itervalues()):
+            fresh._index(index.entries[user_id])
+        return fresh.search(query, limit=500)
+
+    def test_save_compacts(self):
+
+        index = PeopleIndex()
+        self.refresh(index)
+        removed = [self.entries.pop(dn)['cn'][0] for dn in self.dns[:50]]
+        self.refresh(index)
+        name = self.entries[self.dns[60]]['displayName'][0]
+        before = [(score, entry['cn'][0]) for score, entry in index.search(name)]
+
+        index_file = os.path.join(self.folder, 'people.idx')
+        index.save(index_file)
+        self.assertEqual(len(index.entries), 150)
+        loaded = PeopleIndex.load(index_file)
+
+        self.assertEqual(len(loaded), 150)
+        self.assertEqual([(score, entry['cn'][0]) for score, entry in loaded.search(name)], before)
+        for user_ids in loaded.postings.itervalues():
+            self.assertTrue(all(loaded.entries[user_id] is not None for user_id in user_ids))
+        self.assertTrue(all(loaded.get(upi) is None for upi in removed))
+
+if __name__ == '__main__':
+    unittest.main()
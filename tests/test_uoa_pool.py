@@ -0,0 +1,174 @@
+'''
+Tests for uoa_pool.uoa_ldap_pool (checkout, retries, and resuming iter_ldap), run against uoa_fake_ldap.
+
+    python -m unittest discover -s tests
+'''
+
+import threading
+import unittest
+import ldap
+from uoa_groups.uoa_ldap import uoa_ldap, BASEDN
+from uoa_groups.uoa_pool import uoa_ldap_pool
+from uoa_groups.uoa_fake_ldap import FakeDirectory, FakeLDAPObject, generate_population
+
+class StrictLDAPObject(FakeLDAPObject):
+    '''Fails every request after unbind, like python-ldap does.'''
+
+    unbound = False
+
+    def unbind(self):
+        self.unbound = True
+        FakeLDAPObject.unbind(self)
+
+    unbind_s = unbind
+
+    def _request(self, filterstr=None):
+        if self.unbound:
+            raise ldap.LDAPError({'desc': 'LDAP connection invalid'})
+        return FakeLDAPObject._request(self, filterstr)
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.entries = generate_population(300)
+        self.directory = FakeDirectory(self.entries)
+        self.upis = sorted(attrs['cn'][0] for attrs in self.entries.itervalues())
+        self.error_rate = 0.0
+        self.on_request = None
+        self.connections = []
+
+    def connect(self, username, password, url=None, timeout=None):
+
+        conn = StrictLDAPObject(self.directory, error_rate=self.error_rate, on_request=self.on_request)
+        conn.simple_bind_s(username, password)
+        self.connections.append(conn)
+        return conn
+
+    def pool(self, **kwargs):
+
+        return uoa_ldap_pool('user', 'password', backoff=0, connect=self.connect, **kwargs)
+
+    def assert_all_checked_in(self, pool):
+
+        self.assertEqual(getattr(pool._local, 'users', 0), 0)
+        slots = 0
+        while pool._slots.acquire(False):
+            slots += 1
+        self.assertEqual(slots, pool.size)
+
+    def test_generators_share_connection(self):
+
+        pool = self.pool(size=2)
+        first = pool.iter_ldap('(cn=*)', ['cn'])
+        second = pool.iter_ldap('(cn=*)', ['cn'])
+        first.next()
+        second.next()
+        conn = pool._local.conn
+
+        self.assertEqual(len(list(first)), 299)
+        # still checked out, the second generator reads from it
+        self.assertIs(pool._local.conn, conn)
+        self.assertEqual(pool._idle.qsize(), 0)
+
+        other = []
+
+        def check_out():
+            with pool.connection() as c:
+                other.append(c)
+
+        thread = threading.Thread(target=check_out)
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], conn)
+
+        self.assertEqual(len(list(second)), 299)
+        self.assert_all_checked_in(pool)
+
+    def test_queries_in_iter_ldap_loop_are_retried(self):
+
+        self.error_rate = 0.05
+        pool = self.pool(size=1, retries=10)
+
+        found = []
+        for dn, attrs in pool.iter_ldap('(cn=*)', ['cn']):
+            found.append(pool.find_upi(attrs['cn'][0])['cn'][0])
+
+        self.assertEqual(sorted(found), self.upis)
+        # connections that failed were replaced (but unbound only when the loop was finished)
+        self.assertTrue(len(self.connections) > 2)
+        self.assert_all_checked_in(pool)
+
+    def test_retries_exhausted(self):
+
+        def fail_searches(filterstr):
+            if filterstr is not None:
+                raise ldap.SERVER_DOWN({'desc': 'injected'})
+
+        self.on_request = fail_searches
+        pool = self.pool(retries=2)
+
+        with self.assertRaises(Exception) as context:
+            pool.find_upi(self.upis[0])
+        self.assertTrue(str(context.exception).startswith('LDAP query failed'))
+        self.assertNotIsInstance(context.exception, ldap.LDAPError)
+
+        with self.assertRaises(Exception) as context:
+            list(pool.iter_ldap('(cn=*)', ['cn']))
+        self.assertTrue(str(context.exception).startswith('LDAP query failed'))
+        # 3 tries each, the first one on the connection bound by the constructor, all others on fresh ones
+        self.assertEqual(len(self.connections), 6)
+        self.assert_all_checked_in(pool)
+
+    def fail_once(self, request_number, change_directory):
+        '''Fails the request_number-th search (once), and changes the directory before the retry.'''
+
+        requests = []
+
+        def on_request(filterstr):
+            if filterstr is None:
+                return
+            requests.append(filterstr)
+            if len(requests) == request_number:
+                change_directory()
+                raise ldap.SERVER_DOWN({'desc': 'injected'})
+
+        return on_request
+
+    def test_iter_ldap_resumes_by_dn(self):
+
+        dns = sorted(self.entries)
+        added = 'CN=aa000,'+BASEDN
+        changed = dict(self.entries)
+        changed[added] = dict(self.entries[dns[0]], cn=['aa000'])
+        # one that was already yielded, and one that wasn't yet
+        del changed[dns[5]]
+        del changed[dns[250]]
+
+        def change_directory():
+            self.directory = FakeDirectory(changed)
+
+        pool = self.pool(pagesize=100)
+        self.on_request = self.fail_once(2, change_directory)
+        for conn in self.connections:
+            conn.on_request = self.on_request
+
+        yielded = [dn for dn, attrs in pool.iter_ldap('(cn=*)', ['cn'])]
+
+        self.assertEqual(len(yielded), len(set(yielded)))
+        # the first page was yielded before the directory changed
+        self.assertEqual(set(yielded), (set(changed) | set(dns[:100])))
+        self.assert_all_checked_in(pool)
+
+    def test_iter_ldap_without_retries(self):
+
+        self.on_request = self.fail_once(2, lambda: None)
+        client = uoa_ldap('user', 'password', pagesize=100, connect=self.connect)
+
+        results = client.iter_ldap('(cn=*)', ['cn'])
+        with self.assertRaises(Exception) as context:
+            list(results)
+        self.assertTrue(str(context.exception).startswith('LDAP query failed'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+'''
+Tests for uoa_reconcile.DepartmentResolver, and how it follows reloads of the hierarchy.
+
+    python -m unittest discover -s tests
+'''
+
+import gc
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from openpyxl import Workbook
+from uoa_groups.uoa_groups import UoA_groups
+from uoa_groups.uoa_reconcile import DepartmentResolver
+
+HIERARCHY = [
+    ('UOA', 'SCI', 'Science', 'CHEM', 'Chemistry', None, None),
+    ('UOA', 'SCI', 'Science', 'PHYS', 'Physics', None, None),
+    ('UOA', 'SCI', 'Science', 'MATHS', 'Mathematics', 'MATHSA', 'Applied Mathematics'),
+    ('UOA', 'SCI', 'Science', 'SCIOFF', 'Student Office', None, None),
+    ('UOA', 'ART', 'Arts', 'HIST', 'History', None, None),
+    ('UOA', 'ART', 'Arts', 'ARTOFF', 'Student Office', None, None),
+    ('UOA', 'CER', 'eResearch', None, None, None, None)
+]
+
+# CHEM renamed, MATHSA removed, COMPSCI and NESI added, PHYS and ARTOFF moved
+CHANGED_HIERARCHY = [
+    ('UOA', 'SCI', 'Science', 'CHEM', 'Chemical Sciences', None, None),
+    ('UOA', 'SCI', 'Science', 'MATHS', 'Mathematics', None, None),
+    ('UOA', 'SCI', 'Science', 'SCIOFF', 'Student Office', None, None),
+    ('UOA', 'SCI', 'Science', 'COMPSCI', 'Computer Science', None, None),
+    ('UOA', 'ART', 'Arts', 'HIST', 'History', 'ARTOFF', 'Student Office'),
+    ('UOA', 'ART', 'Arts', 'PHYS', 'Physics', None, None),
+    ('UOA', 'CER', 'eResearch', 'NESI', 'NeSI', None, None)
+]
+
+# only ARTOFF moved
+MOVED_HIERARCHY = [row for row in HIERARCHY if row[3] != 'ARTOFF'] + [('UOA', 'ART', 'Arts', 'HIST', 'History', 'ARTOFF', 'Student Office')]
+
+DEPARTMENTS = ['Chemistry', 'Dept of Chemistry', 'School of Chemical Sciences', 'Chem', 'chem', 'Physics', 'Mathematics',
+               'Applied Maths', 'History', 'HIST', 'eResearch', 'CER', 'Computer Science', 'Comp Sci', 'Science',
+               'Student Office', 'NeSI', 'Unknown Unit', '']
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.excel_file = os.path.join(self.folder, 'departments.xlsx')
+        self.writes = 0
+        self.write_workbook(HIERARCHY)
+        self.groups = UoA_groups(self.excel_file)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    def write_workbook(self, rows):
+
+        wb = Workbook()
+        sheet = wb.active
+        sheet.title = 'Data'
+        sheet.append(['L1', 'L2', 'L2 desc', 'L3', 'L3 desc', 'L4', 'L4 desc', 'L5', 'L5 desc'])
+        for row in rows:
+            sheet.append(list(row))
+        wb.save(self.excel_file)
+        self.writes += 1
+        mtime = int(time.time()) + self.writes
+        os.utime(self.excel_file, (mtime, mtime))
+
+    def reload(self, rows):
+
+        self.write_workbook(rows)
+        return self.groups.reload()
+
+    def assert_same_as_fresh(self, resolver):
+
+        fresh = DepartmentResolver(self.groups)
+        for department in DEPARTMENTS:
+            self.assertEqual(resolver.resolve(department), fresh.resolve(department), department)
+        fresh.close()
+
+    def test_resolve(self):
+
+        resolver = DepartmentResolver(self.groups)
+
+        self.assertEqual(resolver.resolve('chem'), ('CHEM', 1.0))
+        self.assertEqual(resolver.resolve('Dept of Chemistry'), ('CHEM', 0.9))
+        self.assertEqual(resolver.resolve('Applied Maths'), ('MATHSA', 1.0))
+        self.assertEqual(resolver.resolve('Unknown Unit'), (None, 0.0))
+        # same name and depth, the first id wins
+        self.assertEqual(resolver.resolve('Student Office'), ('ARTOFF', 0.5))
+
+    def test_reload_matches_fresh_resolver(self):
+
+        resolver = DepartmentResolver(self.groups)
+        for department in DEPARTMENTS:
+            resolver.resolve(department)
+
+        self.reload(CHANGED_HIERARCHY)
+        self.assertEqual(resolver.resolve('Chemical Sciences'), ('CHEM', 1.0))
+        self.assertEqual(resolver.resolve('Student Office'), ('SCIOFF', 0.5))
+        self.assert_same_as_fresh(resolver)
+
+        self.reload(HIERARCHY)
+        self.assert_same_as_fresh(resolver)
+
+    def test_reload_keeps_unaffected_results(self):
+
+        resolver = DepartmentResolver(self.groups)
+        for department in DEPARTMENTS:
+            resolver.resolve(department)
+
+        self.reload(CHANGED_HIERARCHY)
+        index, cache = resolver._state
+
+        for department in ['Physics', 'History', 'HIST', 'eResearch', 'CER', 'Unknown Unit']:
+            self.assertIn(department, cache)
+        # renamed, removed or added groups with the same words, and ties between moved groups
+        for department in ['Chemistry', 'chem', 'Applied Maths', 'Computer Science', 'Science', 'Student Office', 'NeSI']:
+            self.assertNotIn(department, cache)
+
+    def test_moved_groups(self):
+
+        resolver = DepartmentResolver(self.groups)
+        for department in DEPARTMENTS:
+            resolver.resolve(department)
+        index, cache = resolver._state
+
+        diff = self.reload(MOVED_HIERARCHY)
+        self.assertEqual(diff.reparented, {'ARTOFF': ('ART', 'HIST')})
+
+        # names didn't change, so the index is kept, and only ties are resolved again
+        self.assertIs(resolver._state[0], index)
+        self.assertEqual(set(resolver._state[1]), set(cache) - set(['Student Office']))
+        self.assertEqual(resolver.resolve('Student Office'), ('SCIOFF', 0.5))
+        self.assert_same_as_fresh(resolver)
+
+    def test_listener(self):
+
+        resolver = DepartmentResolver(self.groups)
+        self.assertEqual(len(self.groups._listeners), 1)
+        resolver.close()
+        self.assertEqual(self.groups._listeners, [])
+
+        DepartmentResolver(self.groups)
+        gc.collect()
+        # removed with the first reload after the resolver is gone
+        self.reload(CHANGED_HIERARCHY)
+        self.assertEqual(self.groups._listeners, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+'''
+asyncio client for the University of Auckland LDAP directory.
+
+Requests are sent with python-ldap's asynchronous calls (which return a
+message id straight away), and their results are polled without blocking
+from the event loop, so many lookups can be in flight on one connection.
+This needs trollius, which provides the asyncio API on Python 2:
+
+    from trollius import From, Return
+
+    client = uoa_ldap_async(username, password)
+
+    @asyncio.coroutine
+    def lookup():
+        entry = yield From(client.find_upi('mbin029'))
+        entries = yield From(client.find_upis(['mbin029', 'abcd001']))
+
+        results = client.search('(memberOf=...)', ['cn'])
+        while True:
+            try:
+                dn, attrs = yield From(results.__anext__())
+            except StopIteration:
+                break
+            ...
+
+    client.loop.run_until_complete(lookup())
+    client.close_ldap()
+
+All methods return futures (search returns an iterator whose __anext__
+returns a future per entry), so they also work with asyncio.gather and
+asyncio.wait_for. The number of requests in flight is limited by
+max_concurrency, and every request fails with asyncio.TimeoutError if no
+result arrived within timeout seconds (the request is abandoned).
+'''
+
+from collections import deque
+import time
+import ldap
+from uoa_ldap import connect, create_controls, get_pctrls, set_cookie, generate_searchfilter_person, generate_searchfilter_people
+from uoa_ldap import LDAPSERVER, BASEDN, PAGESIZE, DEFAULT_ATTR_LIST
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+try:
+    StopAsyncIteration
+except NameError:
+    # the end of a search is signalled with StopIteration on Python 2
+    StopAsyncIteration = StopIteration
+
+# polling starts with this interval (in seconds), and is doubled up to poll_interval while waiting
+MIN_POLL_INTERVAL = 0.001
+
+def chain(future, func, loop):
+    '''
+    Returns a new future with the result of func(result of future).
+
+    Exceptions are passed on, and cancelling the new future cancels the original one.
+    '''
+
+    chained = asyncio.Future(loop=loop)
+
+    def done(f):
+        if chained.done():
+            return
+        if f.cancelled():
+            chained.cancel()
+        elif f.exception() is not None:
+            chained.set_exception(f.exception())
+        else:
+            try:
+                chained.set_result(func(f.result()))
+            except Exception as e:
+                chained.set_exception(e)
+
+    def cancelled(f):
+        if f.cancelled():
+            future.cancel()
+
+    future.add_done_callback(done)
+    chained.add_done_callback(cancelled)
+    return chained
+
+class PagedSearch(object):
+    '''Asynchronous iterator over the (dn, attrs) tuples of a paged search, fetching one page at a time.'''
+
+    def __init__(self, client, searchfilter, attrlist, scope=ldap.SCOPE_ONELEVEL):
+
+        self.client = client
+        self.searchfilter = searchfilter
+        self.attrlist = attrlist
+        self.scope = scope
+        self.lc = create_controls(client.pagesize)
+        self.buffer = deque()
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+
+        future = asyncio.Future(loop=self.client.loop)
+        self._next(future)
+        return future
+
+    def _next(self, future):
+
+        if future.done():
+            return
+
+        if self.buffer:
+            future.set_result(self.buffer.popleft())
+        elif self.done:
+            future.set_exception(StopAsyncIteration())
+        else:
+            page = self.client.search_page(self.searchfilter, self.attrlist, self.lc, self.scope)
+            page.add_done_callback(lambda p: self._page_done(p, future))
+
+    def _page_done(self, page, future):
+
+        if page.cancelled():
+            future.cancel()
+            return
+        if page.exception() is not None:
+            self.done = True
+            if not future.done():
+                future.set_exception(page.exception())
+            return
+
+        rdata, serverctrls = page.result()
+        # referrals have no dn
+        self.buffer.extend((dn, attrs) for dn, attrs in rdata if dn)
+
+        pctrls = get_pctrls(serverctrls)
+        if not pctrls or not set_cookie(self.lc, pctrls, self.client.pagesize):
+            self.done = True
+
+        self._next(future)
+
+    def collect(self):
+        '''Returns a future of a dict with all results (dn as key), like uoa_ldap.query_ldap.'''
+
+        result = asyncio.Future(loop=self.client.loop)
+        all_users = {}
+
+        def fetch(f=None):
+            if f is not None:
+                if f.cancelled() or result.done():
+                    return
+                if f.exception() is not None:
+                    if not isinstance(f.exception(), StopAsyncIteration):
+                        result.set_exception(f.exception())
+                    else:
+                        result.set_result(all_users)
+                    return
+                dn, attrs = f.result()
+                # referrals (of subtree searches) have no dn
+                if dn:
+                    all_users[dn] = attrs
+                # drain what's already buffered without going through the loop
+                while self.buffer:
+                    dn, attrs = self.buffer.popleft()
+                    if dn:
+                        all_users[dn] = attrs
+
+            self.__anext__().add_done_callback(fetch)
+
+        fetch()
+        return result
+
+class uoa_ldap_async(object):
+    '''asyncio counterpart of uoa_ldap.uoa_ldap.'''
+
+    def __init__(self, username, password, url=LDAPSERVER, loop=None, max_concurrency=10,
+                 timeout=30, poll_interval=0.05, pagesize=PAGESIZE, connect=connect):
+
+        self.username = username
+        self.password = password
+        self.url = url
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.pagesize = pagesize
+
+        # binding is done once, synchronously
+        self.ldap = connect(username, password, url, timeout=timeout)
+
+        self._active = 0
+        self._pending = deque()
+
+    # request handling
+
+    def _acquire(self, start):
+        '''Calls start once less than max_concurrency requests are in flight.'''
+
+        if self._active < self.max_concurrency:
+            self._active += 1
+            start()
+        else:
+            self._pending.append(start)
+
+    def _release(self):
+
+        self._active -= 1
+        if self._pending:
+            self._active += 1
+            self.loop.call_soon(self._pending.popleft())
+
+    def request(self, send):
+        '''
+        Sends a request and returns a future of its (rdata, serverctrls).
+
+        send is a function that takes the connection, sends an asynchronous request
+        and returns its message id.
+        '''
+
+        future = asyncio.Future(loop=self.loop)
+
+        def start():
+            if future.cancelled():
+                self._release()
+                return
+            try:
+                msgid = send(self.ldap)
+            except ldap.LDAPError as e:
+                self._release()
+                future.set_exception(e)
+                return
+            self._poll(msgid, future, time.time()+self.timeout, MIN_POLL_INTERVAL)
+
+        self._acquire(start)
+        return future
+
+    def _poll(self, msgid, future, deadline, interval):
+
+        if future.cancelled():
+            self._abandon(msgid)
+            return
+
+        try:
+            rtype, rdata, rmsgid, serverctrls = self.ldap.result3(msgid, all=1, timeout=0)
+        except ldap.LDAPError as e:
+            self._release()
+            future.set_exception(e)
+            return
+
+        if rtype is not None:
+            self._release()
+            future.set_result((rdata, serverctrls))
+        elif time.time() > deadline:
+            self._abandon(msgid)
+            future.set_exception(asyncio.TimeoutError('No LDAP result within %s seconds' % self.timeout))
+        else:
+            self.loop.call_later(interval, self._poll, msgid, future, deadline, min(interval*2, self.poll_interval))
+
+    def _abandon(self, msgid):
+
+        self._release()
+        try:
+            self.ldap.abandon(msgid)
+        except ldap.LDAPError:
+            pass
+
+    # queries
+
+    def search_page(self, searchfilter, attrlist, lc, scope=ldap.SCOPE_ONELEVEL):
+        '''Requests one page of a paged search (lc is the page control), returns a future of (rdata, serverctrls).'''
+
+        return self.request(lambda conn: conn.search_ext(BASEDN, scope, searchfilter, attrlist, serverctrls=[lc]))
+
+    def search(self, searchfilter, attrlist, scope=ldap.SCOPE_ONELEVEL):
+        '''Returns an asynchronous iterator over the (dn, attrs) of all matching entries.'''
+
+        return PagedSearch(self, searchfilter, attrlist, scope)
+
+    def query_ldap(self, searchfilter, attrlist, scope=ldap.SCOPE_ONELEVEL):
+        '''Returns a future of a dict with all matching entries (dn as key).'''
+
+        return self.search(searchfilter, attrlist, scope).collect()
+
+    def get_all_users_of_group(self, group, attr_list=DEFAULT_ATTR_LIST):
+
+        searchfilter = "(memberOf={})".format(group)
+        return chain(self.query_ldap(searchfilter, attr_list), lambda results: results or None, self.loop)
+
+    def find_upi(self, upi, attr_list=DEFAULT_ATTR_LIST):
+        '''Returns a future of the entry of the user with this exact upi (or None).'''
+
+        def single(results):
+            if len(results) == 0:
+                return None
+            elif len(results) == 1:
+                return results[results.keys()[0]]
+            else:
+                raise Exception("More than one match found.")
+
+        searchfilter = generate_searchfilter_person('cn='+upi)
+        return chain(self.query_ldap(searchfilter, attr_list), single, self.loop)
+
+    def find_upis(self, upis, attr_list=DEFAULT_ATTR_LIST):
+        '''Returns a future of a list with the entries of all upis (None for upis that don't exist).'''
+
+        return asyncio.gather(*[self.find_upi(upi, attr_list) for upi in upis])
+
+    def search_people(self, root_group=None, name=None, roles=None, units=None, attr_list=DEFAULT_ATTR_LIST):
+        '''Returns a future of a dict with all people matching a name, roles and/or units (see uoa_ldap.search_people).'''
+
+        searchfilter = generate_searchfilter_people(root_group, name, roles, units)
+        return self.query_ldap(searchfilter, attr_list, ldap.SCOPE_SUBTREE)
+
+    def search_user(self, search_term, attr_list=DEFAULT_ATTR_LIST):
+        '''Returns a future of a dict with all entries with a matching displayName (searching the whole subtree, like uoa_ldap.search_user).'''
+
+        searchfilter = generate_searchfilter_person('displayName='+search_term)
+        return self.query_ldap(searchfilter, attr_list, ldap.SCOPE_SUBTREE)
+
+    def close_ldap(self):
+        """Call this once you are finished querying."""
+
+        self.ldap.unbind()
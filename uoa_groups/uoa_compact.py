@@ -0,0 +1,245 @@
+'''
+Compact, read-only representation of LDAP entries for bulk queries.
+
+python-ldap returns every entry as a dict of lists of strings, so the same
+few thousand group DNs end up being stored once per user in the memberOf
+lists. Here, DNs are dictionary-encoded into a DNTable that is shared by all
+entries of a query, and each entry only keeps an array of integer ids.
+Other attribute values are interned.
+
+CompactEntry supports the read-only parts of the dict interface that
+researcher.from_ldap_entry (and most other code) uses, so it can be used as
+a drop-in replacement for the entries returned by uoa_ldap.query_ldap.
+
+Compare the memory usage of both representations with:
+
+    python -m uoa_groups.uoa_compact
+'''
+
+import sys
+import random
+import argparse
+from array import array
+
+# attributes that contain DNs and are dictionary-encoded
+ENCODED_ATTRIBUTES = ('memberOf',)
+
+class DNTable(object):
+    '''Shared table of DNs, each one stored once and referenced by its integer id.'''
+
+    def __init__(self):
+        self.dns = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.dns)
+
+    def encode(self, dns):
+        '''Returns an array with the ids of the provided DNs, adding new ones to the table.'''
+
+        ids = array('i')
+        for dn in dns:
+            i = self.ids.get(dn)
+            if i is None:
+                i = len(self.dns)
+                dn = intern(dn)
+                self.dns.append(dn)
+                self.ids[dn] = i
+            ids.append(i)
+
+        return ids
+
+    def id_of(self, dn):
+        '''Returns the id of a DN, or None if it is not in the table.'''
+        return self.ids.get(dn)
+
+class DNList(object):
+    '''Read-only sequence view of an encoded list of DNs.'''
+
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table, ids):
+        self.table = table
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.table.dns[i] for i in self.ids[index]]
+        return self.table.dns[self.ids[index]]
+
+    def __iter__(self):
+        dns = self.table.dns
+        for i in self.ids:
+            yield dns[i]
+
+    def __contains__(self, dn):
+        i = self.table.id_of(dn)
+        return i is not None and i in self.ids
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+class CompactEntry(object):
+    '''Memory efficient, read-only replacement for the attribute dicts returned by python-ldap.'''
+
+    __slots__ = ('table', 'attrs', 'values')
+
+    def __init__(self, attrs, table):
+
+        self.table = table
+        names = []
+        values = []
+        for name, vals in attrs.iteritems():
+            names.append(intern(name))
+            if name in ENCODED_ATTRIBUTES:
+                values.append(table.encode(vals))
+            else:
+                values.append(tuple(intern(v) for v in vals))
+
+        self.attrs = tuple(names)
+        self.values = tuple(values)
+
+    def _value(self, index):
+
+        name = self.attrs[index]
+        if name in ENCODED_ATTRIBUTES:
+            return DNList(self.table, self.values[index])
+        return self.values[index]
+
+    def __getitem__(self, name):
+
+        try:
+            return self._value(self.attrs.index(name))
+        except ValueError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+
+        if name in self.attrs:
+            return self._value(self.attrs.index(name))
+        return default
+
+    def __contains__(self, name):
+        return name in self.attrs
+
+    def __len__(self):
+        return len(self.attrs)
+
+    def __iter__(self):
+        return iter(self.attrs)
+
+    def keys(self):
+        return list(self.attrs)
+
+    def items(self):
+        return [(name, self._value(i)) for i, name in enumerate(self.attrs)]
+
+    def dump(self):
+        '''Returns this entry as tuples of strings (e.g. for marshal), use load() to restore it.'''
+
+        values = tuple(v.tostring() if name in ENCODED_ATTRIBUTES else v for name, v in zip(self.attrs, self.values))
+        return self.attrs, values
+
+    @classmethod
+    def load(cls, data, table):
+        '''Restores an entry returned by dump(), table has to contain the same DNs as when it was dumped.'''
+
+        attrs, values = data
+        entry = cls.__new__(cls)
+        entry.table = table
+        entry.attrs = tuple(intern(str(name)) for name in attrs)
+        entry.values = tuple(array('i', v) if name in ENCODED_ATTRIBUTES else tuple(intern(str(x)) for x in v)
+                             for name, v in zip(entry.attrs, values))
+        return entry
+
+    def to_dict(self):
+        '''Returns this entry in the format python-ldap uses (a dict of lists).'''
+        return dict((name, list(value)) for name, value in self.items())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+# memory benchmark ++++++++++++++++++++++++++++++++++++++++++++
+
+def deep_sizeof(obj, seen=None):
+    '''Returns the size of an object and everything it references, counting shared objects only once.'''
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deep_sizeof(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += deep_sizeof(getattr(obj, name), seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+
+    return size
+
+def generate_entries(num_users, num_groups, groups_per_user, seed=0):
+    '''Generates synthetic query_ldap results, with a new string object for every value (like python-ldap does).'''
+
+    rnd = random.Random(seed)
+    entries = {}
+    for u in xrange(num_users):
+        upi = 'user%03d' % u
+        memberships = ['CN=group%d.uos,OU=uos,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz' % g
+                       for g in rnd.sample(xrange(num_groups), groups_per_user)]
+        entries['CN=%s,OU=People,DC=UoA,DC=auckland,DC=ac,DC=nz' % upi] = {
+            'cn': [upi],
+            'givenName': ['Given%d' % (u % 500)],
+            'sn': ['Surname%d' % (u % 5000)],
+            'mail': ['%s@auckland.ac.nz' % upi],
+            'department': ['Department %d' % (u % 200)],
+            'memberOf': memberships
+        }
+
+    return entries
+
+def benchmark(num_users, num_groups, groups_per_user):
+    '''Returns the deep sizes (in bytes) of the dict-of-lists and the compact representation of the same entries.'''
+
+    entries = generate_entries(num_users, num_groups, groups_per_user)
+    plain_size = deep_sizeof(entries)
+
+    table = DNTable()
+    compact = dict((dn, CompactEntry(attrs, table)) for dn, attrs in entries.iteritems())
+    compact_size = deep_sizeof(compact)
+
+    return plain_size, compact_size
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compare memory usage of plain and compact LDAP entries.')
+    parser.add_argument('--users', type=int, default=20000, help='number of users')
+    parser.add_argument('--groups', type=int, default=3000, help='number of distinct group DNs')
+    parser.add_argument('--groups-per-user', type=int, default=40, help='memberOf values per user')
+    args = parser.parse_args()
+
+    plain_size, compact_size = benchmark(args.users, args.groups, args.groups_per_user)
+
+    print "users: {}, group DNs: {}, memberships per user: {}".format(args.users, args.groups, args.groups_per_user)
+    print "dict of lists:  {:>8.1f} MB".format(plain_size / 1024.0 / 1024.0)
+    print "compact:        {:>8.1f} MB".format(compact_size / 1024.0 / 1024.0)
+    print "ratio:          {:>8.1f} x".format(float(plain_size) / compact_size)
+
+if __name__ == '__main__':
+    main()
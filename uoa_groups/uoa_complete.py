@@ -0,0 +1,182 @@
+'''
+Shell completion for uoa-groups.
+
+Completing has to be fast, so nothing here parses the workbook or talks to
+LDAP, and this module must only import from the standard library. The
+uoa-groups command writes a sorted prefix table of group ids and names
+(whenever the workbook is newer than the table) and a list of recently
+queried upis; the uoa-groups-complete entry point only does a binary
+search over those files.
+
+Enable completion in bash with:
+
+    eval "$(uoa-groups-complete --bash)"
+'''
+
+import os
+import sys
+from bisect import bisect_left
+
+COMPLETION_FOLDER = os.path.join(os.path.expanduser('~'), '.uoa-groups')
+GROUPS_TABLE = os.path.join(COMPLETION_FOLDER, 'completion-groups')
+RECENT_UPIS = os.path.join(COMPLETION_FOLDER, 'recent-upis')
+
+MAX_RECENT_UPIS = 500
+MAX_CANDIDATES = 50
+
+SUBCOMMANDS = ['upi', 'search', 'refresh-index', 'group', 'all-groups', 'snapshot', 'diff', 'index', 'reconcile']
+
+# (subcommand, previous word) combinations that are completed with group ids or upis, None as
+# previous word means the positional argument (after any word that isn't one of these options)
+GROUP_ARGUMENTS = [('group', None), ('search', '--in-unit'), ('index', '--members'), ('index', '-m')]
+UPI_ARGUMENTS = [('upi', None), ('index', '--upi'), ('index', '-u')]
+
+BASH_SCRIPT = '''_uoa_groups() {
+    local cur=${COMP_WORDS[COMP_CWORD]}
+    local prev=${COMP_WORDS[COMP_CWORD-1]}
+    if [ $COMP_CWORD -eq 1 ]; then
+        COMPREPLY=( $(compgen -W "%s" -- "$cur") )
+    else
+        COMPREPLY=( $(uoa-groups-complete "${COMP_WORDS[1]}" "$prev" "$cur") )
+    fi
+}
+complete -F _uoa_groups uoa-groups
+''' % ' '.join(SUBCOMMANDS)
+
+# writing (done by uoa-groups) ++++++++++++++++++++++++++++++++
+
+def _write_lines(path, lines):
+
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp_file = path+'.tmp'
+    with open(tmp_file, 'wb') as f:
+        for line in lines:
+            f.write(line+'\n')
+    os.rename(tmp_file, path)
+
+def group_table_lines(uoa_groups):
+    '''
+    Returns the sorted lines of the completion table for a UoA_groups hierarchy.
+
+    Every line is '<lower case key><TAB><group id>', with the group id and every
+    word-suffix of the group name (so 'chem' finds 'School of Chemical Sciences') as keys.
+    '''
+
+    lines = set()
+    for group in uoa_groups.root.get_subtree():
+        gid = unicode(group.gid).encode('utf-8')
+        lines.add(gid.lower()+'\t'+gid)
+
+        name = unicode(group.name or '').lower().split()
+        for i in range(len(name)):
+            lines.add(u' '.join(name[i:]).encode('utf-8')+'\t'+gid)
+
+    return sorted(lines)
+
+def refresh_group_table(uoa_groups, table=GROUPS_TABLE):
+    '''Writes the completion table for the hierarchy, if it is older than the workbook.'''
+
+    try:
+        if os.path.getmtime(table) >= os.path.getmtime(uoa_groups.excel_file):
+            return False
+    except OSError:
+        pass
+
+    _write_lines(table, group_table_lines(uoa_groups))
+    return True
+
+def remember_upi(upi, recent_upis=RECENT_UPIS):
+    '''Adds a upi to the list of recently used ones.'''
+
+    upi = upi.lower()
+    try:
+        with open(recent_upis, 'rb') as f:
+            upis = [u for u in f.read().split() if u != upi]
+    except IOError:
+        upis = []
+
+    upis.append(upi)
+    _write_lines(recent_upis, upis[-MAX_RECENT_UPIS:])
+
+# completing ++++++++++++++++++++++++++++++++++++++++++++++++
+
+def complete_group(prefix, table=GROUPS_TABLE):
+    '''Returns the group ids whose id or name (or any word-suffix of it) starts with the prefix.'''
+
+    try:
+        with open(table, 'rb') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return []
+
+    prefix = prefix.lower()
+    candidates = []
+    # since '\t' sorts before all printable characters, the lines are sorted by key
+    for line in lines[bisect_left(lines, prefix):]:
+        if not line.startswith(prefix):
+            break
+        gid = line.rsplit('\t', 1)[1]
+        if gid not in candidates:
+            candidates.append(gid)
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+
+    return candidates
+
+def complete_upi(prefix, recent_upis=RECENT_UPIS):
+    '''Returns the recently used upis that start with the prefix.'''
+
+    try:
+        with open(recent_upis, 'rb') as f:
+            upis = sorted(set(f.read().split()))
+    except IOError:
+        return []
+
+    prefix = prefix.lower()
+    candidates = []
+    for upi in upis[bisect_left(upis, prefix):]:
+        if not upi.startswith(prefix) or len(candidates) >= MAX_CANDIDATES:
+            break
+        candidates.append(upi)
+
+    return candidates
+
+def complete(subcommand, previous, prefix):
+    '''Returns the completion candidates for the current word.'''
+
+    if prefix.startswith('-'):
+        return []
+
+    argument = (subcommand, previous)
+    if argument not in GROUP_ARGUMENTS and argument not in UPI_ARGUMENTS:
+        # the previous word is the subcommand, a flag like -d, or the value of another option
+        argument = (subcommand, None)
+
+    if argument in GROUP_ARGUMENTS:
+        return complete_group(prefix)
+    if argument in UPI_ARGUMENTS:
+        return complete_upi(prefix)
+
+    return []
+
+def run():
+
+    args = sys.argv[1:]
+    if args == ['--bash']:
+        sys.stdout.write(BASH_SCRIPT)
+        return
+
+    if len(args) == 2:
+        args.append('')
+    if len(args) != 3:
+        sys.stderr.write('usage: uoa-groups-complete --bash | <subcommand> <previous-word> <current-word>\n')
+        sys.exit(1)
+
+    for candidate in complete(*args):
+        sys.stdout.write(candidate+'\n')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,378 @@
+'''
+In-process stand-in for a python-ldap connection, for trying out and testing
+the uoa_ldap clients without a directory server.
+
+FakeLDAPObject supports the calls uoa_ldap, uoa_ldap_pool and
+uoa_ldap_async make: paged searches (search_ext/result3, including
+non-blocking polling with timeout=0), plain searches (search/result), and
+abandon. Filters are evaluated against the entries of a FakeDirectory (&, |,
+!, equality, presence and * wildcards, case-insensitive like AD), which all
+connections made by one fake_connect share, like connections to one server.
+Latency and errors can be injected, and every request is counted.
+
+    entries = generate_population(1000)
+    ldap = uoa_ldap('user', 'password', connect=fake_connect(entries, latency=0.02))
+'''
+
+import re
+import time
+import random
+import threading
+from collections import OrderedDict
+import ldap
+from uoa_ldap import create_controls, get_pctrls, BASEDN, LDAP24API, GROUP_DN_TEMPLATE
+from uoa_ldap import STAFF_GROUP, STUDENT_GROUP, POSTGRAD_GROUP, CONTRACTOR_GROUP
+
+ACTIVE_GROUP = 'CN=active.ec,OU=ec,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz'
+
+# maximum page size of the server, like MaxPageSize on AD
+MAX_PAGESIZE = 1000
+
+# number of filters whose matching dns are cached, so paging through a result doesn't re-evaluate the filter
+FILTER_CACHE_SIZE = 64
+
+# filter parsing +++++++++++++++++++++++++++++++++++++++++++++
+
+ESCAPE_REGULAR_EXPRESSION = re.compile(r'\\([0-9a-fA-F]{2})')
+
+def _unescape(value):
+    return ESCAPE_REGULAR_EXPRESSION.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+def parse_filter(filterstr):
+    '''Parses an LDAP filter string into nested tuples: ('&', [..]), ('|', [..]), ('!', f), ('=', attr, value).'''
+
+    node, pos = _parse(filterstr, 0)
+    if filterstr[pos:].strip():
+        raise ldap.FILTER_ERROR('Trailing characters in filter: '+filterstr)
+    return node
+
+def _skip(filterstr, pos):
+    while pos < len(filterstr) and filterstr[pos] == ' ':
+        pos += 1
+    return pos
+
+def _parse(filterstr, pos):
+
+    pos = _skip(filterstr, pos)
+    if pos >= len(filterstr) or filterstr[pos] != '(':
+        raise ldap.FILTER_ERROR('Expected "(" in filter: '+filterstr)
+    pos = _skip(filterstr, pos+1)
+
+    op = filterstr[pos]
+    if op in '&|':
+        children = []
+        pos = _skip(filterstr, pos+1)
+        while filterstr[pos] != ')':
+            child, pos = _parse(filterstr, pos)
+            children.append(child)
+            pos = _skip(filterstr, pos)
+        return (op, children), pos+1
+
+    if op == '!':
+        child, pos = _parse(filterstr, pos+1)
+        pos = _skip(filterstr, pos)
+        return ('!', child), pos+1
+
+    end = filterstr.index(')', pos)
+    attr, value = filterstr[pos:end].split('=', 1)
+    return ('=', attr.strip().lower(), value), end+1
+
+def _match_value(pattern, values):
+
+    if pattern == '*':
+        return bool(values)
+
+    if '*' not in pattern:
+        pattern = _unescape(pattern).lower()
+        return any(v.lower() == pattern for v in values)
+
+    regex = re.compile('^'+'.*'.join(re.escape(_unescape(p)) for p in pattern.split('*'))+'$', re.IGNORECASE | re.DOTALL)
+    return any(regex.match(v) for v in values)
+
+def match_filter(node, attrs):
+    '''Returns True if the entry attributes (with lower case keys) match the parsed filter.'''
+
+    op = node[0]
+    if op == '&':
+        return all(match_filter(c, attrs) for c in node[1])
+    if op == '|':
+        return any(match_filter(c, attrs) for c in node[1])
+    if op == '!':
+        return not match_filter(node[1], attrs)
+
+    return _match_value(node[2], attrs.get(node[1], []))
+
+# fake directory +++++++++++++++++++++++++++++++++++++++++++++
+
+def _indexed_cns(node):
+    '''Returns the set of (lower case) cns an equality filter (or a & or | of them) pins down, or None.'''
+
+    if node[0] == '=' and node[1] == 'cn' and '*' not in node[2]:
+        return set([_unescape(node[2]).lower()])
+    if node[0] == '&':
+        for child in node[1]:
+            cns = _indexed_cns(child)
+            if cns is not None:
+                return cns
+    if node[0] == '|':
+        cns = set()
+        for child in node[1]:
+            child_cns = _indexed_cns(child)
+            if child_cns is None:
+                return None
+            cns.update(child_cns)
+        return cns
+    return None
+
+class FakeDirectory(object):
+    '''The entries (a dict of dn: attrs) of a fake server, prepared for searching.'''
+
+    def __init__(self, entries):
+
+        self.entries = entries
+
+        self._lowered = dict((dn, dict((k.lower(), v) for k, v in attrs.iteritems())) for dn, attrs in entries.iteritems())
+        self._sorted_dns = sorted(entries)
+        # cn is indexed (like on AD), so upi lookups (and batches of them) don't have to look at every entry
+        self._by_cn = {}
+        for dn, attrs in self._lowered.iteritems():
+            for cn in attrs.get('cn', ()):
+                self._by_cn.setdefault(cn.lower(), []).append(dn)
+        self._matches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def search(self, base, filterstr):
+        '''Returns the dns of all entries matching the filter.'''
+
+        if not base.lower().endswith(BASEDN.lower()):
+            return []
+
+        with self._lock:
+            dns = self._matches.pop(filterstr, None)
+        if dns is None:
+            node = parse_filter(filterstr)
+            cns = _indexed_cns(node)
+            if cns is None:
+                candidates = self._sorted_dns
+            else:
+                candidates = sorted(set(dn for cn in cns for dn in self._by_cn.get(cn, ())))
+            dns = [dn for dn in candidates if match_filter(node, self._lowered[dn])]
+        with self._lock:
+            self._matches[filterstr] = dns
+            if len(self._matches) > FILTER_CACHE_SIZE:
+                self._matches.popitem(last=False)
+
+        return dns
+
+    def select(self, dns, attrlist):
+        '''Returns the (dn, attrs) tuples for a list of dns, with only the requested attributes.'''
+
+        if not attrlist:
+            return [(dn, self.entries[dn]) for dn in dns]
+
+        wanted = set(a.lower() for a in attrlist)
+        return [(dn, dict((k, v) for k, v in self.entries[dn].iteritems() if k.lower() in wanted)) for dn in dns]
+
+# fake connection ++++++++++++++++++++++++++++++++++++++++++++
+
+class _Request(object):
+
+    def __init__(self, results, ready_at, serverctrls=None):
+        self.results = results
+        self.ready_at = ready_at
+        self.serverctrls = serverctrls or []
+        self.position = 0
+
+class FakeLDAPObject(object):
+    '''
+    Fake python-ldap connection over a FakeDirectory (or a dict of (dn, attrs) entries).
+
+    latency: seconds before the result of each request is available
+    jitter: up to this many seconds are randomly added to the latency of each request
+    error_rate: probability that a request fails with ldap.SERVER_DOWN
+    max_pagesize: the largest page the "server" returns
+    on_request: function that is called with the filter of every request (None for binds and other requests)
+    '''
+
+    def __init__(self, entries, latency=0.0, error_rate=0.0, max_pagesize=MAX_PAGESIZE, seed=None, jitter=0.0, on_request=None):
+
+        if not isinstance(entries, FakeDirectory):
+            entries = FakeDirectory(entries)
+        self.directory = entries
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_pagesize = max_pagesize
+        self.on_request = on_request
+        self.random = random.Random(seed)
+
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._next_msgid = 1
+
+        # number of requests sent to the "server"
+        self.round_trips = 0
+        self.bound = False
+
+    # connection handling
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        self._request()
+        self.bound = True
+
+    def whoami_s(self):
+        self._request()
+        return 'u:fake'
+
+    def unbind(self):
+        self.bound = False
+
+    unbind_s = unbind
+
+    def abandon(self, msgid):
+        with self._lock:
+            self._requests.pop(msgid, None)
+
+    # searches
+
+    def _request(self, filterstr=None):
+        '''Counts a request, fails it if an error is injected, returns the time its result is ready.'''
+
+        if self.on_request:
+            self.on_request(filterstr)
+
+        with self._lock:
+            self.round_trips += 1
+            fail = self.error_rate and self.random.random() < self.error_rate
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if fail:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server (injected)"})
+
+        return time.time()+delay
+
+    def _add_request(self, request):
+
+        with self._lock:
+            msgid = self._next_msgid
+            self._next_msgid += 1
+            self._requests[msgid] = request
+        return msgid
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+
+        ready_at = self._request(filterstr)
+        dns = self.directory.search(base, filterstr)
+
+        pctrls = get_pctrls(serverctrls or [])
+        if not pctrls:
+            return self._add_request(_Request(self.directory.select(dns, attrlist), ready_at))
+
+        if LDAP24API:
+            size, cookie = pctrls[0].size, pctrls[0].cookie
+        else:
+            size, cookie = pctrls[0].controlValue
+
+        size = min(size or self.max_pagesize, self.max_pagesize)
+        start = int(cookie) if cookie else 0
+        end = start+size
+
+        reply = create_controls(size)
+        next_cookie = str(end) if end < len(dns) else ''
+        if LDAP24API:
+            reply.cookie = next_cookie
+        else:
+            reply.controlValue = (len(dns), next_cookie)
+
+        return self._add_request(_Request(self.directory.select(dns[start:end], attrlist), ready_at, [reply]))
+
+    def search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.search_ext(base, scope, filterstr, attrlist, attrsonly)
+
+    def _wait(self, msgid, timeout):
+        '''Returns the request, once it is ready, or None if it isn't ready within the timeout.'''
+
+        with self._lock:
+            request = self._requests.get(msgid)
+        if request is None:
+            raise ldap.NO_SUCH_OPERATION({'desc': 'No such operation: %s' % msgid})
+
+        remaining = request.ready_at - time.time()
+        if remaining > 0:
+            if timeout is not None and timeout >= 0 and timeout < remaining:
+                if timeout > 0:
+                    time.sleep(timeout)
+                    raise ldap.TIMEOUT({'desc': 'Timed out'})
+                return None
+            time.sleep(remaining)
+
+        return request
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+
+        request = self._wait(msgid, timeout)
+        if request is None:
+            return None, None, None, None
+
+        if all:
+            self.abandon(msgid)
+            return ldap.RES_SEARCH_RESULT, request.results, msgid, request.serverctrls
+
+        if request.position < len(request.results):
+            entry = request.results[request.position]
+            request.position += 1
+            return ldap.RES_SEARCH_ENTRY, [entry], msgid, []
+
+        self.abandon(msgid)
+        return ldap.RES_SEARCH_RESULT, [], msgid, request.serverctrls
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+
+        rtype, rdata, rmsgid, serverctrls = self.result3(msgid, all, timeout)
+        return rtype, rdata
+
+def fake_connect(entries, **kwargs):
+    '''Returns a connect function (see uoa_ldap.connect) that binds a new FakeLDAPObject for every call.'''
+
+    if not isinstance(entries, FakeDirectory):
+        entries = FakeDirectory(entries)
+
+    def connect(username, password, url=None, timeout=None):
+        conn = FakeLDAPObject(entries, **kwargs)
+        conn.simple_bind_s(username, password)
+        return conn
+
+    return connect
+
+# synthetic data +++++++++++++++++++++++++++++++++++++++++++++
+
+GIVEN_NAMES = ['Aroha', 'Mere', 'T\xc4\x81ne', 'Wiremu', 'Sione', 'Losa', 'Anna', 'James', 'Mei', 'Priya', 'Lucas', 'Sophie']
+SURNAMES = ['Ngata', 'Tait', 'Pomare', 'Fa\xe2\x80\x98asua', 'Smith', 'Wong', 'Patel', 'Brown', 'M\xc4\x81ori', 'Taufa', 'Williams', 'Chen']
+
+def generate_population(num_users, units=('SCI', 'ART', 'ENG', 'MED', 'BUS'), seed=0):
+    '''Generates entries for num_users active users (as python-ldap returns them: utf-8 encoded strings).'''
+
+    rnd = random.Random(seed)
+    roles = [STAFF_GROUP, STUDENT_GROUP, POSTGRAD_GROUP, CONTRACTOR_GROUP]
+    entries = {}
+    for i in xrange(num_users):
+        upi = '{}{}{:03d}'.format(rnd.choice('abcdefghijklmnopqrstuvwxyz'), rnd.choice('abcdefghijklmnopqrstuvwxyz'), i)
+        given = rnd.choice(GIVEN_NAMES)
+        sn = rnd.choice(SURNAMES)
+        unit = rnd.choice(units)
+        entries['CN={},{}'.format(upi, BASEDN)] = {
+            'cn': [upi],
+            'givenName': [given],
+            'sn': [sn],
+            'displayName': [given+' '+sn],
+            'mail': [upi+'@auckland.ac.nz'],
+            'department': [unit],
+            'objectCategory': ['person'],
+            'objectClass': ['top', 'person', 'user'],
+            'memberOf': [ACTIVE_GROUP, GROUP_DN_TEMPLATE.format(unit), rnd.choice(roles)],
+            'whenChanged': ['20160501000000.0Z']
+        }
+
+    return entries
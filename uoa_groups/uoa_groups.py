@@ -16,6 +16,8 @@ Install from git:
 
 import os.path
 import logging
+import hashlib
+import threading
 import uoa_ldap
 
 from openpyxl import Workbook, load_workbook
@@ -123,6 +125,15 @@ class UoA_group(object):
         return search_matches
 
 
+    def get_subtree(self):
+        """Returns a list with this group and all the groups below it."""
+
+        subtree = [self]
+        for c in self.childs:
+            subtree.extend(c.get_subtree())
+
+        return subtree
+
     def is_root_group(self):
         """Returns True if this group does not have a parent."""
         return self.parent == None
@@ -137,75 +148,283 @@ class UoA_group(object):
 
         return self.parent.is_child_of(other)
         
+def subtree_hashes(root):
+    '''Returns a dict with a hash of every group's subtree (ids and names of all groups in it), with group ids as keys.'''
+
+    hashes = {}
+
+    def visit(group):
+        h = hashlib.sha1()
+        h.update(unicode(group.gid).encode('utf-8')+'\0'+unicode(group.name).encode('utf-8'))
+        for child_hash in sorted(visit(c) for c in group.childs):
+            h.update('\0'+child_hash)
+        hashes[group.gid] = h.hexdigest()
+        return hashes[group.gid]
+
+    visit(root)
+    return hashes
+
+class GroupsDiff(object):
+    '''
+    Structural differences between two versions of the hierarchy.
+
+    added and removed are sets of group ids, renamed maps group ids to (old name, new name),
+    reparented maps group ids to (old parent id, new parent id). invalidated contains the ids
+    of all groups whose subtree changed in any way (including added and removed ones), caches
+    that are derived from a group's subtree only need to be rebuilt for those.
+    '''
+
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+        self.renamed = {}
+        self.reparented = {}
+        self.invalidated = set()
+
+    def is_empty(self):
+        return not self.invalidated
+
+    def __str__(self):
+        return "added: {}, removed: {}, renamed: {}, reparented: {}".format(
+            sorted(self.added), sorted(self.removed), sorted(self.renamed), sorted(self.reparented))
+
+def diff_trees(old_root, old_hashes, new_root, new_hashes):
+    '''
+    Computes the GroupsDiff between two hierarchies, given their subtree_hashes.
+
+    Subtrees with the same hash in both versions are not descended into.
+    '''
+
+    diff = GroupsDiff()
+    diff.invalidated = set(gid for gid, h in new_hashes.iteritems() if old_hashes.get(gid) != h)
+    diff.invalidated.update(gid for gid in old_hashes if gid not in new_hashes)
+    if not diff.invalidated:
+        return diff
+
+    def changed_groups(root, hashes, other_hashes):
+        '''Returns all groups whose subtree changed, plus their direct children.'''
+        groups = {}
+        pending = [root]
+        while pending:
+            group = pending.pop()
+            groups[group.gid] = group
+            if hashes[group.gid] != other_hashes.get(group.gid):
+                pending.extend(group.childs)
+        return groups
+
+    old_groups = changed_groups(old_root, old_hashes, new_hashes)
+    new_groups = changed_groups(new_root, new_hashes, old_hashes)
+
+    diff.added = set(gid for gid in new_groups if gid not in old_hashes)
+    diff.removed = set(gid for gid in old_groups if gid not in new_hashes)
+
+    for gid in set(old_groups).union(new_groups):
+        if gid in diff.added or gid in diff.removed:
+            continue
+        # a group that was only reached on one side is unchanged on the other, so look it up there
+        old = old_groups.get(gid) or old_root.get_child(gid, False)
+        new = new_groups.get(gid) or new_root.get_child(gid, False)
+        if old.name != new.name:
+            diff.renamed[gid] = (old.name, new.name)
+        old_parent = old.parent.gid if old.parent else None
+        new_parent = new.parent.gid if new.parent else None
+        if old_parent != new_parent:
+            diff.reparented[gid] = (old_parent, new_parent)
+
+    return diff
+
+def parse_hierarchy(excel_file):
+    '''Parses the Excel file provided by UoA HR, returns the workbook, the data sheet and the root group.'''
+
+    wb = load_workbook(excel_file)
+    sheet = wb.get_sheet_by_name("Data")
+
+    root_gid = sheet['A2'].value
+    root_name = "University of Auckland"
+    root = UoA_group(root_gid, root_name)
+    
+    for row in range(2, sheet.max_row + 1):
+        l1 = sheet['A'+str(row)].value
+        if not l1 == root_gid:
+            raise Exception("Error in spreadsheet: "+str(root_gid)+" != "+str(l1))
+        l1_desc = root_name
+        l1_group = UoA_group(l1, l1_desc)
+
+        l2 = sheet['B'+str(row)].value
+        if not l2:
+            continue
+        l2_desc = sheet['C'+str(row)].value
+        
+        root.add_child(l2, l2_desc)
+        l2_group = root.get_child(l2)
+
+        if not l2_group:
+            root.print_tree()
+            raise Exception("No group 2: "+str(l2))
+
+        l3 = sheet['D'+str(row)].value
+        if not l3:
+            continue
+        l3_desc = sheet['E'+str(row)].value
+
+        l2_group.add_child(l3, l3_desc)
+        l3_group = root.get_child(l3)
+
+        if not l3_group:
+            root.print_tree()
+            raise Exception("No group 3: "+str(l3))
+
+        
+        l4 = sheet['F'+str(row)].value
+        if not l4:
+            continue
+        l4_desc = sheet['G'+str(row)].value
+
+        l3_group.add_child(l4, l4_desc)
+        l4_group = root.get_child(l4)
+
+        if not l4_group:
+            root.print_tree()
+            raise Exception("No group 4: "+str(l4))
+
+        
+        l5 = sheet['H'+str(row)].value
+        if not l5:
+            continue
+        l5_desc = sheet['I'+str(row)].value
+
+        l4_group.add_child(l5, l5_desc)
+
+    return wb, sheet, root
+
 class UoA_groups(object):
     '''
     Base class to create and encapsulate the UoA hierarchy.
+
+    The hierarchy can be reloaded (see reload and watch) while other threads are using it. The
+    whole tree is replaced in one step, so readers see either the old or the new version.
     '''
     
     def __init__(self, excel_file):
         '''Parsed using an Excel file provided by UoA HR.'''
         
         self.excel_file = excel_file
-        self.wb = load_workbook(excel_file)
-        self.sheet = self.wb.get_sheet_by_name("Data")
-
-        self.root_gid = self.sheet['A2'].value
         self.root_name = "University of Auckland"
-        self.root = UoA_group(self.root_gid, self.root_name)
-        
-        for row in range(2, self.sheet.max_row + 1):
-            l1 = self.sheet['A'+str(row)].value
-            if not l1 == self.root_gid:
-                raise Exception("Error in spreadsheet: "+str(self.root_gid)+" != "+str(l1))
-            l1_desc = self.root_name
-            l1_group = UoA_group(l1, l1_desc)
-
-            l2 = self.sheet['B'+str(row)].value
-            if not l2:
-                continue
-            l2_desc = self.sheet['C'+str(row)].value
-            
-            self.root.add_child(l2, l2_desc)
-            l2_group = self.root.get_child(l2)
 
-            if not l2_group:
-                self.root.print_tree()
-                raise Exception("No group 2: "+str(l2))
+        self._signature = self._file_signature()
+        wb, sheet, root = parse_hierarchy(excel_file)
+        self._tree = (wb, sheet, root, subtree_hashes(root))
 
-            l3 = self.sheet['D'+str(row)].value
-            if not l3:
-                continue
-            l3_desc = self.sheet['E'+str(row)].value
+        self._reload_lock = threading.Lock()
+        self._listeners = []
+        self._watcher = None
+        self._stop_watching = threading.Event()
 
-            l2_group.add_child(l3, l3_desc)
-            l3_group = self.root.get_child(l3)
+    @property
+    def wb(self):
+        return self._tree[0]
 
-            if not l3_group:
-                self.root.print_tree()
-                raise Exception("No group 3: "+str(l3))
+    @property
+    def sheet(self):
+        return self._tree[1]
 
-            
-            l4 = self.sheet['F'+str(row)].value
-            if not l4:
-                continue
-            l4_desc = self.sheet['G'+str(row)].value
+    @property
+    def root(self):
+        return self._tree[2]
 
-            l3_group.add_child(l4, l4_desc)
-            l4_group = self.root.get_child(l4)
+    @property
+    def root_gid(self):
+        return self._tree[2].gid
 
-            if not l4_group:
-                self.root.print_tree()
-                raise Exception("No group 4: "+str(l4))
+    @property
+    def hashes(self):
+        return self._tree[3]
 
-            
-            l5 = self.sheet['H'+str(row)].value
-            if not l5:
+    def _file_signature(self):
+
+        stat = os.stat(self.excel_file)
+        return (stat.st_mtime, stat.st_size)
+
+    def add_listener(self, listener):
+        '''Registers a function that is called with (this object, GroupsDiff) after every reload that changed the hierarchy.'''
+
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        '''Unregisters a function registered with add_listener.'''
+
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def reload(self):
+        '''Parses the Excel file again and swaps in the new hierarchy, returns the GroupsDiff to the previous one.'''
+
+        with self._reload_lock:
+            signature = self._file_signature()
+            wb, sheet, root = parse_hierarchy(self.excel_file)
+            hashes = subtree_hashes(root)
+
+            old_tree = self._tree
+            diff = diff_trees(old_tree[2], old_tree[3], root, hashes)
+
+            # a single assignment, so readers never see parts of different versions
+            self._tree = (wb, sheet, root, hashes)
+            self._signature = signature
+
+        if not diff.is_empty():
+            logging.info("Reloaded "+str(self.excel_file)+": "+str(diff))
+            # listeners may remove themselves
+            for listener in list(self._listeners):
+                try:
+                    listener(self, diff)
+                except Exception:
+                    logging.exception("Listener failed after reload")
+
+        return diff
+
+    def watch(self, interval=60):
+        '''Starts a background thread that reloads the Excel file whenever it changed.'''
+
+        if self._watcher:
+            return
+
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="uoa-groups-watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop_watching(self):
+        '''Stops the thread started by watch.'''
+
+        if not self._watcher:
+            return
+
+        self._stop_watching.set()
+        self._watcher.join()
+        self._watcher = None
+
+    def _watch(self, interval):
+
+        last_seen = self._signature
+        while not self._stop_watching.wait(interval):
+            try:
+                signature = self._file_signature()
+            except OSError:
+                # file is being replaced
                 continue
-            l5_desc = self.sheet['I'+str(row)].value
 
-            l4_group.add_child(l5, l5_desc)
-        
-            
+            # only reload once the file didn't change for one interval, so it's not read while being written
+            if signature != self._signature and signature == last_seen:
+                try:
+                    self.reload()
+                except Exception:
+                    logging.exception("Could not reload "+str(self.excel_file)+", keeping the current hierarchy")
+                    # don't try again until the file changes
+                    self._signature = signature
+            last_seen = signature
+
     def print_tree(self):
         """Prints the entire group hierarchy."""
         self.root.print_tree()
@@ -227,7 +446,10 @@ class UoA_groups(object):
     def get_high_level_groups(self, list_of_group_ids):
         '''Filter out group tree-branches that are already part of one or more, higher-level group tree-branches.'''
 
-        groups = [g for g in (self.get_group(gid) for gid in list_of_group_ids)]
+        # use the same version of the hierarchy for all lookups
+        root = self.root
+        # group ids that are not part of the hierarchy are ignored
+        groups = [g for g in (root.get_child(gid, False) for gid in list_of_group_ids) if g]
 
         return filter_duplicate_groups(groups)
 
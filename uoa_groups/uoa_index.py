@@ -0,0 +1,174 @@
+'''
+In-memory, bidirectional user <-> group index over the UoA hierarchy.
+
+The index is built from a single paged scan of the active population and
+answers both "which groups is this user in?" and "who is in this group
+(or anywhere below it)?" without further LDAP round trips.
+
+Groups are numbered in pre-order of the hierarchy, which makes the subtree
+of a group the contiguous id range [group_id, subtree_end[group_id]). Users
+are numbered in sorted upi order, so member lists (arrays of user ids) are
+also sorted by upi.
+'''
+
+import os
+import marshal
+from array import array
+from uoa_ldap import SEARCHFILTER, extract_group_ids
+
+INDEX_VERSION = 1
+
+def number_groups(root):
+    '''Returns the pre-order list of group ids below (and including) root, and the end of each subtree.'''
+
+    gids = []
+    subtree_end = []
+
+    def visit(group):
+        i = len(gids)
+        gids.append(intern(str(group.gid)))
+        subtree_end.append(0)
+        for c in group.childs:
+            visit(c)
+        subtree_end[i] = len(gids)
+
+    visit(root)
+    return gids, array('i', subtree_end)
+
+class GroupIndex(object):
+    '''
+    Bidirectional index between upis and the groups of the UoA hierarchy.
+
+    user_groups holds the high-level group ids of each user (the same groups
+    researcher.groups would list), group_users the user ids of the direct
+    members of each group.
+    '''
+
+    def __init__(self, gids, subtree_end, upis, user_groups, group_users):
+
+        self.gids = gids
+        self.subtree_end = subtree_end
+        self.upis = upis
+        self.user_groups = user_groups
+        self.group_users = group_users
+
+        self.group_ids = dict((gid, i) for i, gid in enumerate(gids))
+        self.user_ids = dict((upi, i) for i, upi in enumerate(upis))
+
+    @classmethod
+    def build(cls, ldap, uoa_groups, searchfilter=SEARCHFILTER):
+        '''Builds the index from one paged scan of all users matching the searchfilter.'''
+
+        gids, subtree_end = number_groups(uoa_groups.root)
+        group_ids = dict((gid, i) for i, gid in enumerate(gids))
+
+        memberships = []
+        for dn, attrs in ldap.iter_ldap(searchfilter, ['cn', 'memberOf']):
+            if not dn:
+                # referral
+                continue
+            ids = set(group_ids[gid] for gid in extract_group_ids(attrs.get('memberOf')) if gid in group_ids)
+            memberships.append((intern(attrs['cn'][0]), sorted(ids)))
+
+        memberships.sort()
+
+        upis = []
+        user_groups = []
+        group_users = [array('i') for gid in gids]
+        for user_id, (upi, ids) in enumerate(memberships):
+            upis.append(upi)
+            for group_id in ids:
+                group_users[group_id].append(user_id)
+            user_groups.append(cls._high_level(ids, subtree_end))
+
+        return cls(gids, subtree_end, upis, user_groups, group_users)
+
+    @staticmethod
+    def _high_level(ids, subtree_end):
+        '''
+        Filters out the (sorted) group ids that have another one of the ids in their subtree, the
+        same way uoa_groups.filter_duplicate_groups does.
+        '''
+
+        high_level = array('H')
+        for i, group_id in enumerate(ids):
+            # ids are in pre-order, so if any other id is in this subtree, the next one is
+            if i+1 < len(ids) and ids[i+1] < subtree_end[group_id]:
+                continue
+            high_level.append(group_id)
+
+        return high_level
+
+    @classmethod
+    def load(cls, index_file):
+        '''Loads an index that was written with save().'''
+
+        with open(index_file, 'rb') as f:
+            data = marshal.load(f)
+
+        if data.get('version') != INDEX_VERSION:
+            raise Exception("Unsupported index version in: "+str(index_file))
+
+        gids = [intern(gid) for gid in data['gids']]
+        upis = [intern(upi) for upi in data['upis']]
+        subtree_end = array('i', data['subtree_end'])
+        user_groups = [array('H', ids) for ids in data['user_groups']]
+        group_users = [array('i', ids) for ids in data['group_users']]
+
+        return cls(gids, subtree_end, upis, user_groups, group_users)
+
+    def save(self, index_file):
+        '''Writes this index to a file, replacing it atomically.'''
+
+        data = {
+            'version': INDEX_VERSION,
+            'gids': self.gids,
+            'upis': self.upis,
+            'subtree_end': self.subtree_end.tostring(),
+            'user_groups': [ids.tostring() for ids in self.user_groups],
+            'group_users': [ids.tostring() for ids in self.group_users]
+        }
+
+        tmp_file = index_file+'.tmp'
+        with open(tmp_file, 'wb') as f:
+            marshal.dump(data, f)
+        os.rename(tmp_file, index_file)
+
+    def groups_of(self, upi):
+        '''Returns the ids of the high-level groups the user is member of, or None if the upi is not indexed.'''
+
+        user_id = self.user_ids.get(upi)
+        if user_id is None:
+            return None
+
+        return [self.gids[group_id] for group_id in self.user_groups[user_id]]
+
+    def users_of(self, gid, subtree=False):
+        '''
+        Returns the sorted upis of all direct members of a group, or None if the group doesn't exist.
+
+        If subtree is True, members of all the groups below it are included too.
+        '''
+
+        group_id = self.group_ids.get(gid)
+        if group_id is None:
+            return None
+
+        if not subtree:
+            user_ids = self.group_users[group_id]
+        else:
+            user_ids = set()
+            for i in xrange(group_id, self.subtree_end[group_id]):
+                user_ids.update(self.group_users[i])
+            user_ids = sorted(user_ids)
+
+        return [self.upis[user_id] for user_id in user_ids]
+
+    def subtree(self, gid):
+        '''Returns the ids of all groups below (and including) the specified group.'''
+
+        group_id = self.group_ids.get(gid)
+        if group_id is None:
+            return []
+
+        return self.gids[group_id:self.subtree_end[group_id]]
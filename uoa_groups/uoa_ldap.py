@@ -6,12 +6,14 @@ import sys
 import ldap
 import csv
 from xml.dom.minidom import parseString
-from blist import sortedset
 from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from distutils.version import StrictVersion
 from xml.etree.ElementTree import Element, SubElement, Comment, tostring, ElementTree
 import re
+from contextlib import contextmanager
 import uoa_groups
+from uoa_compact import DNTable, CompactEntry
 
 # Check if we're using the Python "ldap" 2.4 or greater API
 LDAP24API = StrictVersion(ldap.__version__) >= StrictVersion('2.4')
@@ -22,6 +24,7 @@ BASEDN = 'ou=People,dc=UoA,dc=auckland,dc=ac,dc=nz'
 PAGESIZE = 1000
 SEARCHFILTER = '(& (cn=*)(objectCategory=person)(objectClass=user)(department=*)(memberOf=CN=active.ec,OU=ec,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz))'
 GROUP_REGULAR_EXPRESSION = re.compile('^CN=([A-Z]*)\.uos,OU=uos,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz$')
+GROUP_DN_TEMPLATE = 'CN={}.uos,OU=uos,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz'
 DEFAULT_ATTR_LIST = ['cn', 'givenName', 'department', 'sn', 'mail', 'memberOf']
 
 STAFF_GROUP = "CN=UniStaff.ec,OU=ec,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz"
@@ -30,6 +33,18 @@ POSTGRAD_GROUP = "CN=Postgraduate.psrwi,OU=psrwi,OU=Groups,DC=UoA,DC=auckland,DC
 DOCTORAL_STUDENT_GROUP = "CN=doctoralstudent.psrwi,OU=psrwi,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz"
 CONTRACTOR_GROUP = "CN=Contractor.psrwi,OU=psrwi,OU=Groups,DC=UoA,DC=auckland,DC=ac,DC=nz"
 
+# errors that are likely to go away when retrying on a fresh connection
+TRANSIENT_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR, ldap.UNAVAILABLE, ldap.BUSY)
+
+# short names for the role groups above, as used in snapshots and on the command line
+ROLE_GROUPS = {
+    'staff': STAFF_GROUP,
+    'student': STUDENT_GROUP,
+    'postgrad': POSTGRAD_GROUP,
+    'doctoral-student': DOCTORAL_STUDENT_GROUP,
+    'contractor': CONTRACTOR_GROUP
+}
+
 # LDAP helper methods ++++++++++++++++++++++++++++++++++++++++
 
 def create_controls(pagesize):
@@ -66,7 +81,7 @@ def set_cookie(lc_object, pctrls, pagesize):
         return cookie
 
 # This is essentially a placeholder callback function. You would do your real
-# work inside of this. Really this should be all abstracted into a generator...
+# work inside of this. Use uoa_ldap.iter_ldap if you want to stream entries instead.
 def process_entry(dn, attrs, all_users):
     """Process an entry. The two arguments passed are the DN and
        a dictionary of attributes."""
@@ -94,98 +109,261 @@ def generate_searchfilter_person(filter):
         searchfilter = '(& ('+filter+')(objectCategory=person)(objectClass=user))'
         return searchfilter
 
+def extract_group_ids(list_of_memberships):
+    """Returns the group ids of all the '.uos' (hierarchy) groups in a list of memberOf DNs."""
+
+    if not list_of_memberships:
+        return []
+
+    matches = (GROUP_REGULAR_EXPRESSION.match(cn) for cn in list_of_memberships)
+    return [m.group(1) for m in matches if m]
+
+def generate_searchfilter_people(root_group=None, name=None, roles=None, units=None):
+    """Compiles a filtered people search into a single LDAP filter.
+
+    name is matched against displayName, with wildcards added on both sides ('*' in
+    the name is kept as wildcard, everything else is escaped). roles are keys of ROLE_GROUPS
+    (or group DNs), a user has to be member of at least one of them. units are group ids
+    of the hierarchy (root_group is needed to look them up), a user has to be member of
+    at least one of them, or of any group below them."""
+
+    clauses = ['(objectCategory=person)', '(objectClass=user)']
+
+    if name:
+        pattern = '*'.join(escape_filter_chars(part) for part in name.strip('*').split('*'))
+        clauses.append('(displayName=*'+pattern+'*)')
+
+    if roles:
+        dns = [ROLE_GROUPS.get(role, role) for role in roles]
+        clauses.append(generate_searchfilter_any('memberOf', dns))
+
+    if units:
+        dns = set()
+        for gid in units:
+            group = root_group.get_group(gid, True)
+            if not group:
+                raise Exception("No group with id: "+str(gid))
+            dns.update(GROUP_DN_TEMPLATE.format(g.gid) for g in group.get_subtree())
+        clauses.append(generate_searchfilter_any('memberOf', sorted(dns)))
+
+    return '(&'+''.join(clauses)+')'
+
+def generate_searchfilter_any(attribute, values):
+    """Returns a filter that matches if the attribute has any of the values."""
+
+    clauses = ['('+attribute+'='+escape_filter_chars(v)+')' for v in values]
+    if len(clauses) == 1:
+        return clauses[0]
+    return '(|'+''.join(clauses)+')'
+
 def find_high_level_groups(root_group, list_of_memberships):
 
     if not list_of_memberships:
         return []
     
-    abbrevs= [GROUP_REGULAR_EXPRESSION.match(cn).group(1) for cn in list_of_memberships if GROUP_REGULAR_EXPRESSION.match(cn)]
+    abbrevs = extract_group_ids(list_of_memberships)
 
     return root_group.get_high_level_groups(abbrevs)
 
 
+def connect(username, password, url=LDAPSERVER, timeout=None):
+    """Returns a new, bound LDAP connection.
+
+    All options are set on the connection itself, not process-wide. Transient errors
+    (see TRANSIENT_ERRORS) are raised as they are, so callers can retry."""
+
+    conn = ldap.initialize(url)
+    conn.protocol_version = 3          # Paged results only apply to LDAP v3
+
+    # Ignore server side certificate errors (assumes using LDAPS and
+    # self-signed cert). Not necessary if not LDAPS or it's signed by
+    # a real CA.
+    conn.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
+    # TLS options only take effect for this connection once a new TLS context is created
+    conn.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+    # Don't follow referrals
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+
+    if timeout:
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, timeout)
+
+    try:
+        conn.simple_bind_s(username, password)
+    except TRANSIENT_ERRORS:
+        raise
+    except ldap.LDAPError as e:
+        raise Exception('LDAP bind failed: %s' % e)
+
+    return conn
+
+
 class uoa_ldap(object):
-    '''Wrapper object that encapsulates important base-LDAP queries.'''
+    '''Wrapper object that encapsulates important base-LDAP queries.
 
-    def __init__(self, username, password):
+    Uses a single connection, so instances must not be shared between threads (use
+    uoa_pool.uoa_ldap_pool for that).'''
+
+    def __init__(self, username, password, url=LDAPSERVER, pagesize=PAGESIZE, connect=connect):
         
         self.username = username
         self.password = password
+        self.url = url
+        self.pagesize = pagesize
+
+        try:
+            self.ldap = connect(self.username, self.password, self.url)
+        except TRANSIENT_ERRORS as e:
+            raise Exception('LDAP bind failed: %s' % e)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that provides the connection to run requests on."""
+
+        yield self.ldap
 
-        # Ignore server side certificate errors (assumes using LDAPS and
-        # self-signed cert). Not necessary if not LDAPS or it's signed by
-        # a real CA.
-        ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
-        # Don't follow referrals
-        ldap.set_option(ldap.OPT_REFERRALS, 0)
+    def _execute(self, operation):
+        """Runs a query (a function without arguments that uses self.connection())."""
 
-        self.ldap = ldap.initialize(LDAPSERVER)
-        self.ldap.protocol_version = 3          # Paged results only apply to LDAP v3
         try:
-            self.ldap.simple_bind_s(self.username, self.password)
-        except ldap.LDAPError as e:
-            exit('LDAP bind failed: %s' % e)
+            return operation()
+        except TRANSIENT_ERRORS as e:
+            raise Exception('LDAP query failed: %s' % e)
 
+    def _retry(self, attempt):
+        """Called after the attempt-th try of a query failed with a transient error,
+        returns True (after waiting, if necessary) if it should be tried again."""
 
-    def query_ldap(self, searchfilter, attrlist):
+        return False
+
+    def iter_ldap(self, searchfilter, attrlist):
+        """Generator that yields (dn, attrs) tuples, one page at a time.
 
-        # Create the page control to work from
-        lc = create_controls(PAGESIZE)
+        Use this instead of query_ldap when streaming over large result sets, so
+        the whole result never has to be held in memory.
 
-        all_users = {}
-        # Do searches until we run out of "pages" to get from
-        # the LDAP server.
+        If the client retries transient errors (see uoa_pool), the search is started
+        again on a fresh connection, and the entries that were already yielded are
+        skipped by their dn (without a sort control, the server doesn't necessarily
+        return them in the same order). Retries are counted from the last try that
+        yielded new entries."""
+
+        yielded = set()
+        progress = 0
+        attempt = 0
         while True:
-            # Send search request
-            try:
-                # If you leave out the ATTRLIST it'll return all attributes
-                # which you have permissions to access. You may want to adjust
-                # the scope level as well (perhaps "ldap.SCOPE_SUBTREE", but
-                # it can reduce performance if you don't need it).
-                msgid = self.ldap.search_ext(BASEDN, ldap.SCOPE_ONELEVEL, searchfilter,
-                                     attrlist, serverctrls=[lc])
-            except ldap.LDAPError as e:
-                raise Exception('LDAP search failed: %s' % e)
-
-            # Pull the results from the search request
             try:
-                rtype, rdata, rmsgid, serverctrls = self.ldap.result3(msgid)
-            except ldap.LDAPError as e:
-                raise Exception('Could not pull LDAP results: %s' % e)
-
-            # Each "rdata" is a tuple of the form (dn, attrs), where dn is
-            # a string containing the DN (distinguished name) of the entry,
-            # and attrs is a dictionary containing the attributes associated
-            # with the entry. The keys of attrs are strings, and the associated
-            # values are lists of strings.
-            for dn, attrs in rdata:
+                for dn, attrs in self._iter_pages(searchfilter, attrlist):
+                    if dn:
+                        if dn in yielded:
+                            continue
+                        yielded.add(dn)
+                    yield dn, attrs
+                return
+            except TRANSIENT_ERRORS as e:
+                if len(yielded) > progress:
+                    # the last try got further than any before, so start counting again
+                    progress = len(yielded)
+                    attempt = 0
+                if not self._retry(attempt):
+                    raise Exception('LDAP query failed: %s' % e)
+                attempt += 1
+
+    def _iter_pages(self, searchfilter, attrlist, scope=ldap.SCOPE_ONELEVEL):
+        """Like iter_ldap, but transient errors are raised as they are (for use within _execute)."""
+
+        with self.connection() as conn:
+            # Create the page control to work from
+            lc = create_controls(self.pagesize)
+
+            # Do searches until we run out of "pages" to get from
+            # the LDAP server.
+            while True:
+                # Send search request
+                try:
+                    # If you leave out the ATTRLIST it'll return all attributes
+                    # which you have permissions to access. You may want to adjust
+                    # the scope level as well (perhaps "ldap.SCOPE_SUBTREE", but
+                    # it can reduce performance if you don't need it).
+                    msgid = conn.search_ext(BASEDN, scope, searchfilter,
+                                         attrlist, serverctrls=[lc])
+                except TRANSIENT_ERRORS:
+                    raise
+                except ldap.LDAPError as e:
+                    raise Exception('LDAP search failed: %s' % e)
+
+                # Pull the results from the search request
+                try:
+                    rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+                except TRANSIENT_ERRORS:
+                    raise
+                except ldap.LDAPError as e:
+                    raise Exception('Could not pull LDAP results: %s' % e)
+
+                # Each "rdata" is a tuple of the form (dn, attrs), where dn is
+                # a string containing the DN (distinguished name) of the entry,
+                # and attrs is a dictionary containing the attributes associated
+                # with the entry. The keys of attrs are strings, and the associated
+                # values are lists of strings.
+                for dn, attrs in rdata:
+                    yield dn, attrs
+
+                # Get cookie for next request
+                pctrls = get_pctrls(serverctrls)
+                if not pctrls:
+                    print >> sys.stderr, 'Warning: Server ignores RFC 2696 control.'
+                    break
+                # Ok, we did find the page control, yank the cookie from it and
+                # insert it into the control for our next search. If however there
+                # is no cookie, we are done!
+                cookie = set_cookie(lc, pctrls, self.pagesize)
+                if not cookie:
+                    break
+
+    def query_ldap(self, searchfilter, attrlist):
+
+        def query():
+            all_users = {}
+            for dn, attrs in self._iter_pages(searchfilter, attrlist):
                 process_entry(dn, attrs, all_users)
+            return all_users
+
+        return self._execute(query)
+
+    def query_ldap_compact(self, searchfilter, attrlist, table=None):
+        """Like query_ldap, but returns uoa_compact.CompactEntry objects instead of dicts.
+
+        All DNs are stored in one shared uoa_compact.DNTable (a new one, unless provided),
+        which reduces memory usage a lot for bulk queries."""
 
-            # Get cookie for next request
-            pctrls = get_pctrls(serverctrls)
-            if not pctrls:
-                print >> sys.stderr, 'Warning: Server ignores RFC 2696 control.'
-                break
-            # Ok, we did find the page control, yank the cookie from it and
-            # insert it into the control for our next search. If however there
-            # is no cookie, we are done!
-            cookie = set_cookie(lc, pctrls, PAGESIZE)
-            if not cookie:
-                break
+        if table is None:
+            table = DNTable()
 
-        return all_users
+        def query():
+            all_users = {}
+            for dn, attrs in self._iter_pages(searchfilter, attrlist):
+                if dn:
+                    all_users[dn] = CompactEntry(attrs, table)
+            return all_users
+
+        return self._execute(query)
 
     def close_ldap(self):
         """Call this once you are finished querying."""
         
         self.ldap.unbind()
 
-    def get_all_users_of_group(self, group, attr_list=DEFAULT_ATTR_LIST):
-        """Finds all active users."""
+    def get_all_users_of_group(self, group, attr_list=DEFAULT_ATTR_LIST, compact=False):
+        """Finds all active users.
+
+        Set compact to True to get uoa_compact.CompactEntry objects, which use a lot less memory for big groups."""
 
         searchfilter = "(memberOf={})".format(group)
 
-        results = self.query_ldap(searchfilter, attr_list)
+        if compact:
+            results = self.query_ldap_compact(searchfilter, attr_list)
+        else:
+            results = self.query_ldap(searchfilter, attr_list)
 
         if len(results) == 0:
             return None
@@ -206,11 +384,13 @@ class uoa_ldap(object):
             raise Exception("More than one match found.")
         
 
-    def list_groups_for_upi(self, upi):
-        """List all the UoA groups this upi is member of."""
+    def list_groups_for_upi(self, upi, root_group):
+        """List all the UoA groups (of the uoa_groups.UoA_groups hierarchy) this upi is member of."""
 
         user = self.find_upi(upi, ['memberOf'])
-        return find_high_level_groups(user['memberOf'])
+        if not user:
+            raise Exception("No entry found for upi: "+str(upi))
+        return find_high_level_groups(root_group, user.get('memberOf', []))
 
         
     def find_matching_upis(self, upi_search_string, attr_list=DEFAULT_ATTR_LIST):
@@ -218,71 +398,69 @@ class uoa_ldap(object):
 
         searchfilter = '(& (cn='+upi_search_string+')(objectCategory=person)(objectClass=user))'
 
-        results = self.query_ldap(ldap, searchfilter, attr_list)
+        results = self.query_ldap(searchfilter, attr_list)
 
         return results
 
         
-    def get_user_details(upi, attr_list=DEFAULT_ATTR_LIST):
+    def search_all(self, searchfilter, attr_list, error_message="Could not search for user: %s"):
+        """Performs a (non-paged) subtree search and returns a list with the result data of every entry."""
+
+        def search():
+            with self.connection() as conn:
+                try:
+                    ldap_result_id = conn.search(BASEDN, ldap.SCOPE_SUBTREE, searchfilter, attr_list)
+                    result_set = []
+                    while 1:
+                        result_type, result_data = conn.result(ldap_result_id, 0)
+                        if (result_data == []):
+                            break
+                        else:
+                            # if you are expecting multiple results you can append them
+                            # otherwise you can just wait until the initial result and break out
+                            if result_type == ldap.RES_SEARCH_ENTRY:
+                                result_set.append(result_data)
+
+                    return result_set
+                except TRANSIENT_ERRORS:
+                    raise
+                except ldap.LDAPError as e:
+                    raise Exception(error_message % e)
+
+        return self._execute(search)
+
+    def get_user_details(self, upi, attr_list=DEFAULT_ATTR_LIST):
         """Return all associated LDAP properties for a user/upi."""
 
-        try:
-            searchfilter = '(cn='+upi+')'
-            ldap_result_id = self.ldap.search(BASEDN, ldap.SCOPE_SUBTREE, searchfilter, attr_list)
-            result_set = []
-            while 1:
-                result_type, result_data = self.ldap.result(ldap_result_id, 0)
-                if (result_data == []):
-                    break
-                else:
-                    # if you are expecting multiple results you can append them
-                    # otherwise you can just wait until the initial result and break out
-                    if result_type == ldap.RES_SEARCH_ENTRY:
-                        result_set.append(result_data)
-            return result_set
-        except ldap.LDAPError as e:
-            raise Exception("Could not get user details: %s" % e)
-
-    def search_user_first_last_name(givenName, surname, attr_list=DEFAULT_ATTR_LIST):
+        searchfilter = '(cn='+upi+')'
+        return self.search_all(searchfilter, attr_list, "Could not get user details: %s")
+
+    def search_user_first_last_name(self, givenName, surname, attr_list=DEFAULT_ATTR_LIST):
         """Performs a LDAP query for a first & last name."""
 
-        try:
-            searchfilter = '(&(sn='+surname+')(givenName='+givenName+'))'
-            ldap_result_id = self.ldap.search(BASEDN, ldap.SCOPE_SUBTREE, searchfilter, attr_list)
-            result_set = []
-            while 1:
-                result_type, result_data = self.ldap.result(ldap_result_id, 0)
-                if (result_data == []):
-                    break
-                else:
-                    # if you are expecting multiple results you can append them
-                    # otherwise you can just wait until the initial result and break out
-                    if result_type == ldap.RES_SEARCH_ENTRY:
-                        result_set.append(result_data)
-                        
-            return result_set
-        except ldap.LDAPError as e:
-            raise Exception("Could not search for user: %s" % e)
+        searchfilter = '(&(sn='+surname+')(givenName='+givenName+'))'
+        return self.search_all(searchfilter, attr_list)
 
+    def search_people(self, root_group=None, name=None, roles=None, units=None, attr_list=DEFAULT_ATTR_LIST):
+        """Returns all people matching a name, roles and/or hierarchy units as a dict with the dn as key.
+
+        All filtering is done by the LDAP server, see generate_searchfilter_people. Like search_user,
+        this searches the whole subtree below BASEDN."""
+
+        searchfilter = generate_searchfilter_people(root_group, name, roles, units)
+
+        def query():
+            all_users = {}
+            for dn, attrs in self._iter_pages(searchfilter, attr_list, ldap.SCOPE_SUBTREE):
+                # referrals have no dn
+                if dn:
+                    all_users[dn] = attrs
+            return all_users
+
+        return self._execute(query)
 
     def search_user(self, search_term, attr_list=DEFAULT_ATTR_LIST):
         """Performs a LDAP query for a first & last name."""
 
-        try:
-            searchfilter = generate_searchfilter_person('displayName='+search_term)
-            ldap_result_id = self.ldap.search(BASEDN, ldap.SCOPE_SUBTREE, searchfilter, attr_list)
-            result_set = []
-            while 1:
-                result_type, result_data = self.ldap.result(ldap_result_id, 0)
-                if (result_data == []):
-                    break
-                else:
-                    # if you are expecting multiple results you can append them
-                    # otherwise you can just wait until the initial result and break out
-                    if result_type == ldap.RES_SEARCH_ENTRY:
-                        result_set.append(result_data)
-                        
-            return result_set
-        except ldap.LDAPError as e:
-            raise Exception("Could not search for user: %s" % e)
-        
+        searchfilter = generate_searchfilter_person('displayName='+search_term)
+        return self.search_all(searchfilter, attr_list)
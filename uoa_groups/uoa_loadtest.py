@@ -0,0 +1,294 @@
+'''
+Load test of the LDAP query paths, against the in-process fake directory.
+
+Runs a mix of upi lookups (find_upi), name searches (search_user) and group
+pulls (get_all_users_of_group) with a number of concurrent workers, and
+reports throughput, latency percentiles and LDAP round trips per operation.
+Latency, jitter, error rate and the server's maximum page size are injected
+by uoa_fake_ldap; the size of group pulls is users/units. Every combination
+of the given client modes and page sizes is run, with the same operations:
+
+    python -m uoa_groups.uoa_loadtest --users 20000 --units 10 --workers 8 \\
+        --latency 0.02 --mode single pool async --pagesize 100 1000
+
+Client modes:
+
+ - single: every worker has its own uoa_ldap (with its own connection)
+ - pool: all workers share one uoa_ldap_pool with --pool-size connections
+ - async: one uoa_ldap_async, with up to --workers requests in flight
+
+Note that the fake evaluates filters in-process, so its CPU time is part of
+the measured latencies (it caches the results of recent filters).
+'''
+
+import sys
+import time
+import random
+import argparse
+import threading
+from uoa_ldap import uoa_ldap, generate_searchfilter_person, GROUP_DN_TEMPLATE, PAGESIZE, DEFAULT_ATTR_LIST
+from uoa_pool import uoa_ldap_pool
+from uoa_fake_ldap import FakeDirectory, fake_connect, generate_population, GIVEN_NAMES, SURNAMES, MAX_PAGESIZE
+
+MODES = ('single', 'pool', 'async')
+OPERATIONS = ('upi', 'name', 'group')
+DEFAULT_MIX = 'upi=70,name=20,group=10'
+
+def parse_mix(mix):
+    '''Parses 'upi=70,name=20,group=10' into a dict of operation weights.'''
+
+    weights = {}
+    for part in mix.split(','):
+        op, weight = part.split('=')
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise Exception("Unknown operation in mix: "+op)
+        weights[op] = float(weight)
+
+    return weights
+
+def percentile(sorted_values, p):
+    '''Returns the p-th percentile (nearest rank) of a sorted list.'''
+
+    if not sorted_values:
+        return 0.0
+    rank = int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+class Workload(object):
+    '''A fixed list of operations, and the search filter each one sends (to attribute round trips).'''
+
+    def __init__(self, entries, units, weights, num_operations, seed=0):
+
+        rnd = random.Random(seed)
+        upis = sorted(attrs['cn'][0] for attrs in entries.itervalues())
+        ops = sorted(weights)
+        total = sum(weights.itervalues())
+
+        self.operations = []
+        self.filters = {}
+        for i in xrange(num_operations):
+            r = rnd.random() * total
+            for op in ops:
+                r -= weights[op]
+                if r < 0:
+                    break
+
+            if op == 'upi':
+                arg = rnd.choice(upis)
+                searchfilter = generate_searchfilter_person('cn='+arg)
+            elif op == 'name':
+                arg = rnd.choice(GIVEN_NAMES)+' '+rnd.choice(SURNAMES)
+                searchfilter = generate_searchfilter_person('displayName='+arg)
+            else:
+                arg = GROUP_DN_TEMPLATE.format(rnd.choice(units))
+                searchfilter = "(memberOf={})".format(arg)
+
+            self.operations.append((op, arg))
+            self.filters[searchfilter] = op
+
+class Stats(object):
+    '''Collects latencies, errors and round trips per operation (thread-safe).'''
+
+    def __init__(self, filters):
+
+        self.filters = filters
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = dict((op, 0) for op in OPERATIONS)
+        # requests without a filter (binds, connection checks) are counted as 'other'
+        self.round_trips = dict((op, 0) for op in OPERATIONS + ('other',))
+        self._lock = threading.Lock()
+
+    def on_request(self, filterstr):
+
+        op = self.filters.get(filterstr, 'other')
+        with self._lock:
+            self.round_trips[op] += 1
+
+    def record(self, op, seconds, failed):
+
+        with self._lock:
+            if failed:
+                self.errors[op] += 1
+            else:
+                self.latencies[op].append(seconds)
+
+    def report(self, wall_time, out=sys.stdout):
+
+        out.write("{:<8} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>12}\n".format(
+            'op', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'round trips'))
+
+        all_latencies = []
+        for op in OPERATIONS + ('total',):
+            if op == 'total':
+                latencies = sorted(all_latencies)
+                errors = sum(self.errors.itervalues())
+                round_trips = sum(self.round_trips[o] for o in OPERATIONS)
+            else:
+                latencies = sorted(self.latencies[op])
+                errors = self.errors[op]
+                round_trips = self.round_trips[op]
+                all_latencies.extend(latencies)
+
+            count = len(latencies) + errors
+            if not count:
+                continue
+            out.write("{:<8} {:>7} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>12.2f}\n".format(
+                op, count, errors, len(latencies) / wall_time,
+                percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+                float(round_trips) / count))
+
+        out.write("{} round trips for binds and connection checks, {:.2f}s\n".format(self.round_trips['other'], wall_time))
+
+def run_operation(client, op, arg):
+
+    if op == 'upi':
+        return client.find_upi(arg)
+    elif op == 'name':
+        return client.search_user(arg)
+    else:
+        return client.get_all_users_of_group(arg, DEFAULT_ATTR_LIST)
+
+def run_threads(clients, operations, stats):
+    '''Runs the operations with one thread per client, returns the wall time.'''
+
+    pending = iter(operations)
+    lock = threading.Lock()
+
+    def worker(client):
+        while True:
+            with lock:
+                try:
+                    op, arg = pending.next()
+                except StopIteration:
+                    return
+            start = time.time()
+            try:
+                run_operation(client, op, arg)
+                failed = False
+            except Exception:
+                failed = True
+            stats.record(op, time.time() - start, failed)
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return time.time() - start
+
+def run_async(client, operations, workers, stats):
+    '''Keeps up to workers operations in flight on the asyncio client, returns the wall time.'''
+
+    from uoa_async import asyncio
+
+    loop = client.loop
+    pending = iter(operations)
+    finished = asyncio.Future(loop=loop)
+    state = {'running': 0}
+
+    def start_next():
+        try:
+            op, arg = pending.next()
+        except StopIteration:
+            if not state['running'] and not finished.done():
+                finished.set_result(None)
+            return
+
+        state['running'] += 1
+        started = time.time()
+        future = run_operation(client, op, arg)
+
+        def done(f):
+            state['running'] -= 1
+            stats.record(op, time.time() - started, f.cancelled() or f.exception() is not None)
+            start_next()
+
+        future.add_done_callback(done)
+
+    start = time.time()
+    for i in xrange(workers):
+        start_next()
+    loop.run_until_complete(finished)
+
+    return time.time() - start
+
+def create_client(factory, attempts=10):
+    '''Creates a client, retrying failed binds (with an injected error rate, binds fail too).'''
+
+    for attempt in xrange(attempts):
+        try:
+            return factory()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+
+def run(mode, directory, workload, workers, pagesize, pool_size=None, latency=0.0, jitter=0.0, error_rate=0.0,
+        max_pagesize=MAX_PAGESIZE):
+    '''Runs the workload with one client mode and page size, returns (Stats, wall time).'''
+
+    stats = Stats(workload.filters)
+    connect = fake_connect(directory, latency=latency, jitter=jitter, error_rate=error_rate,
+                           max_pagesize=max_pagesize, on_request=stats.on_request)
+
+    if mode == 'single':
+        clients = [create_client(lambda: uoa_ldap('user', 'password', pagesize=pagesize, connect=connect)) for i in xrange(workers)]
+        wall_time = run_threads(clients, workload.operations, stats)
+        for c in clients:
+            c.close_ldap()
+    elif mode == 'pool':
+        client = create_client(lambda: uoa_ldap_pool('user', 'password', size=pool_size or workers, backoff=0.01,
+                                                     pagesize=pagesize, connect=connect))
+        wall_time = run_threads([client] * workers, workload.operations, stats)
+        client.close_ldap()
+    elif mode == 'async':
+        from uoa_async import uoa_ldap_async, asyncio
+        loop = asyncio.new_event_loop()
+        client = create_client(lambda: uoa_ldap_async('user', 'password', loop=loop, max_concurrency=workers, poll_interval=0.005,
+                                                      pagesize=pagesize, connect=connect))
+        wall_time = run_async(client, workload.operations, workers, stats)
+        client.close_ldap()
+        loop.close()
+    else:
+        raise Exception("Unknown client mode: "+str(mode))
+
+    return stats, wall_time
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Load test the LDAP query paths against a fake directory.')
+    parser.add_argument('--users', type=int, default=5000, help='number of users in the directory')
+    parser.add_argument('--units', type=int, default=5, help='number of units (group pulls return users/units entries)')
+    parser.add_argument('--operations', type=int, default=1000, help='number of operations per run')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the operations (default: {})'.format(DEFAULT_MIX))
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent workers')
+    parser.add_argument('--mode', nargs='+', choices=MODES, default=['pool'], help='client mode(s) to run')
+    parser.add_argument('--pagesize', type=int, nargs='+', default=[PAGESIZE], help='page size(s) to run')
+    parser.add_argument('--pool-size', type=int, help='connections of the pool (default: number of workers)')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds are added to each request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability that a request fails')
+    parser.add_argument('--max-pagesize', type=int, default=MAX_PAGESIZE, help='largest page the server returns')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    units = ['UNIT{:02d}'.format(i) for i in xrange(args.units)]
+    entries = generate_population(args.users, units, args.seed)
+    directory = FakeDirectory(entries)
+    workload = Workload(entries, units, parse_mix(args.mix), args.operations, args.seed)
+
+    print "users: {}, units: {}, operations: {}, workers: {}, latency: {}s (+{}s), error rate: {}".format(
+        args.users, args.units, args.operations, args.workers, args.latency, args.jitter, args.error_rate)
+
+    for mode in args.mode:
+        for pagesize in args.pagesize:
+            print ""
+            print "mode: {}, page size: {}".format(mode, pagesize)
+            stats, wall_time = run(mode, directory, workload, args.workers, pagesize, args.pool_size, args.latency,
+                                   args.jitter, args.error_rate, args.max_pagesize)
+            stats.report(wall_time)
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,8 @@ def pretty_print_researcher(researcher, print_roles, print_groups, print_departm
         print ""
         print "Department:"
         print "\t"+researcher.department
+        if researcher.department_group:
+            print "\tResolved to: {} (confidence: {:.2f})".format(researcher.department_group, researcher.department_confidence)
 
     print ""
 
@@ -47,18 +49,20 @@ class researcher():
     '''Object to encapsulate all relevant details for a researcher, including associated groups.'''
 
     @classmethod
-    def from_upi(cls, upi, root_group, ldap):
+    def from_upi(cls, upi, root_group, ldap, resolver=None):
         '''
         Creates a researcher object from upi, using the provided group hierarchy for group information.
+
+        If a uoa_reconcile.DepartmentResolver is provided, the department is mapped to a group too.
         '''
         ldap_entry = ldap.find_upi(upi)
         if not ldap_entry:
             raise Exception("No entry found for upi: "+str(upi))
 
-        return cls.from_ldap_entry(ldap_entry, root_group)
+        return cls.from_ldap_entry(ldap_entry, root_group, resolver)
 
     @classmethod
-    def from_ldap_entry(cls, ldap_entry, root_group):
+    def from_ldap_entry(cls, ldap_entry, root_group, resolver=None):
         if ldap_entry.get('department', None):
             if len(ldap_entry['department']) == 1:
                 dep = ldap_entry['department'][0]
@@ -67,7 +71,12 @@ class researcher():
         else:
             dep = 'n/a'
 
-        return cls(ldap_entry['cn'], ldap_entry['givenName'], ldap_entry.get('sn', 'n/a'), ldap_entry.get('mail', None), dep, ldap_entry.get('memberOf'), root_group)
+        res = cls(ldap_entry['cn'], ldap_entry['givenName'], ldap_entry.get('sn', 'n/a'), ldap_entry.get('mail', None), dep, ldap_entry.get('memberOf'), root_group)
+
+        if resolver and dep != 'n/a':
+            res.department_group, res.department_confidence = resolver.resolve_group(dep)
+
+        return res
 
     def __init__(self, cn, first_name, last_name, mail, department, memberships, root_group):
         self.cn = cn[0]
@@ -80,6 +89,9 @@ class researcher():
             self.mail = self.cn + "@aucklanduni.co.nz"
             
         self.department = department
+        # the group the department string was resolved to, see uoa_reconcile
+        self.department_group = None
+        self.department_confidence = 0.0
 
         if memberships:
             self.groups = find_high_level_groups(root_group, memberships)
@@ -0,0 +1,261 @@
+'''
+Local, fuzzy people search over a cached copy of the directory.
+
+PeopleIndex keeps the entries of all active users (in the compact
+representation of uoa_compact) together with a trigram index over their
+givenName, sn and displayName. Names are folded before indexing and
+searching (lower case, accents and macrons removed, apostrophes and
+'okina dropped), so a search for 'Tane' finds the name with a macron too,
+and names with typos still match most of their trigrams. Results are ranked
+by the share of the query's trigrams that a name contains.
+
+The index is kept on disk (marshal format) and refreshed incrementally:
+a cheap scan of (cn, whenChanged) finds new, changed and removed users,
+and only new and changed ones are fetched in full. Note that AD does not
+update whenChanged when group memberships change, so roles and groups of
+cached entries can get stale until the next full refresh.
+'''
+
+import os
+import heapq
+import marshal
+import unicodedata
+from array import array
+from uoa_ldap import SEARCHFILTER, DEFAULT_ATTR_LIST, generate_searchfilter_any
+from uoa_compact import DNTable, CompactEntry
+
+INDEX_VERSION = 1
+INDEX_ATTR_LIST = DEFAULT_ATTR_LIST + ['displayName', 'whenChanged']
+NAME_ATTRIBUTES = ('givenName', 'sn', 'displayName')
+
+# apostrophes (and the 'okina) are dropped instead of splitting a name
+APOSTROPHES = u"'`\u2018\u2019\u02bb\u02bc"
+
+# if more than this share of users changed, a full scan is cheaper than fetching them in batches
+FULL_SCAN_RATIO = 0.1
+
+def fold(text):
+    '''Returns the lower case, accent-free words of text (unicode or utf-8 encoded), separated by single spaces.'''
+
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+
+    chars = []
+    for c in unicodedata.normalize('NFKD', text):
+        if unicodedata.combining(c) or c in APOSTROPHES:
+            continue
+        chars.append(c.lower() if c.isalnum() else u' ')
+
+    return u' '.join(u''.join(chars).split())
+
+def trigrams(folded):
+    '''Returns the set of trigrams of all words of an already folded string, words are padded with '$'.'''
+
+    grams = set()
+    for word in folded.split():
+        word = u'$'+word+u'$'
+        if len(word) == 3:
+            grams.add(word)
+        for i in xrange(len(word)-2):
+            grams.add(word[i:i+3])
+
+    return grams
+
+def name_trigrams(entry):
+
+    grams = set()
+    for attr in NAME_ATTRIBUTES:
+        for value in entry.get(attr, ()):
+            grams.update(trigrams(fold(value)))
+
+    return grams
+
+class PeopleIndex(object):
+    '''Trigram index over the names of cached directory entries.'''
+
+    def __init__(self):
+
+        self.table = DNTable()
+        # CompactEntry per user id, None for removed users
+        self.entries = []
+        self.gram_counts = array('H')
+        self.user_ids = {}
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    # building
+
+    def add(self, attrs):
+        '''Adds (or replaces) the entry of a user.'''
+
+        upi = attrs['cn'][0]
+        if upi in self.user_ids:
+            self.remove(upi)
+
+        self._index(CompactEntry(attrs, self.table))
+
+    def _index(self, entry):
+
+        user_id = len(self.entries)
+        grams = name_trigrams(entry)
+
+        self.entries.append(entry)
+        self.gram_counts.append(len(grams))
+        self.user_ids[entry['cn'][0]] = user_id
+        for gram in grams:
+            self.postings.setdefault(gram, array('i')).append(user_id)
+
+    def remove(self, upi):
+        '''Removes the entry of a user (searches skip it, it's dropped from the postings when the index is compacted).'''
+
+        # removing the user id from the postings right away would scan the (long) postings
+        # of common trigrams like '$ma' for every removed or updated user
+        user_id = self.user_ids.pop(upi)
+        self.entries[user_id] = None
+
+    def refresh(self, ldap, full=False, searchfilter=SEARCHFILTER, batch_size=100):
+        '''
+        Brings the index up to date with LDAP, returns the number of (added or updated, removed) users.
+
+        Unless full is True, only entries that are new or have changed since the last refresh are fetched.
+        '''
+
+        if full:
+            current = None
+            stale = None
+        else:
+            current = {}
+            for dn, attrs in ldap.iter_ldap(searchfilter, ['cn', 'whenChanged']):
+                if dn:
+                    current[attrs['cn'][0]] = attrs.get('whenChanged', [''])[0]
+
+            stale = [upi for upi, changed in current.iteritems() if not self._is_current(upi, changed)]
+
+        if stale is None or len(stale) > FULL_SCAN_RATIO * len(current):
+            # cheaper to just pull everything
+            updated = 0
+            seen = set()
+            for dn, attrs in ldap.iter_ldap(searchfilter, INDEX_ATTR_LIST):
+                if not dn:
+                    continue
+                upi = attrs['cn'][0]
+                seen.add(upi)
+                if full or not self._is_current(upi, attrs.get('whenChanged', [''])[0]):
+                    self.add(attrs)
+                    updated += 1
+            current = seen
+        else:
+            updated = 0
+            for i in xrange(0, len(stale), batch_size):
+                batch_filter = '(&'+searchfilter+generate_searchfilter_any('cn', stale[i:i+batch_size])+')'
+                for dn, attrs in ldap.iter_ldap(batch_filter, INDEX_ATTR_LIST):
+                    if dn:
+                        self.add(attrs)
+                        updated += 1
+
+        removed = [upi for upi in self.user_ids if upi not in current]
+        for upi in removed:
+            self.remove(upi)
+
+        return updated, len(removed)
+
+    def _is_current(self, upi, changed):
+
+        user_id = self.user_ids.get(upi)
+        if user_id is None:
+            return False
+
+        return self.entries[user_id].get('whenChanged', ('',))[0] == changed
+
+    # searching
+
+    def search(self, query, limit=20, min_score=0.3):
+        '''
+        Returns up to limit (score, entry) tuples for the best matches of query, best first.
+
+        The score is the share (0 to 1) of the query's trigrams that are part of the name.
+        '''
+
+        query_grams = trigrams(fold(query))
+        if not query_grams:
+            return []
+
+        counts = {}
+        for gram in query_grams:
+            for user_id in self.postings.get(gram, ()):
+                counts[user_id] = counts.get(user_id, 0) + 1
+
+        total = float(len(query_grams))
+        minimum = min_score * total
+        # for the same score, shorter names (fewer trigrams not in the query) rank higher
+        # removed users are still in the postings until the index is compacted
+        candidates = ((shared, -self.gram_counts[user_id], user_id) for user_id, shared in counts.iteritems()
+                      if shared >= minimum and self.entries[user_id] is not None)
+        best = heapq.nlargest(limit, candidates)
+
+        return [(shared / total, self.entries[user_id]) for shared, unused, user_id in best]
+
+    def get(self, upi):
+        '''Returns the cached entry of a user, or None.'''
+
+        user_id = self.user_ids.get(upi)
+        if user_id is None:
+            return None
+        return self.entries[user_id]
+
+    # storage
+
+    @classmethod
+    def load(cls, index_file):
+        '''Loads an index that was written with save().'''
+
+        with open(index_file, 'rb') as f:
+            data = marshal.load(f)
+
+        if data.get('version') != INDEX_VERSION:
+            raise Exception("Unsupported index version in: "+str(index_file))
+
+        index = cls()
+        for dn in data['dns']:
+            index.table.encode([dn])
+
+        index.entries = [CompactEntry.load(e, index.table) if e is not None else None for e in data['entries']]
+        index.gram_counts = array('H', data['gram_counts'])
+        index.user_ids = dict((e['cn'][0], i) for i, e in enumerate(index.entries) if e is not None)
+        index.postings = dict((gram, array('i', ids)) for gram, ids in data['postings'].iteritems())
+
+        return index
+
+    def save(self, index_file):
+        '''Writes this index to a file, replacing it atomically. Removed users are compacted away first.'''
+
+        if len(self.user_ids) < len(self.entries):
+            self._compact()
+
+        data = {
+            'version': INDEX_VERSION,
+            'dns': self.table.dns,
+            'entries': [e.dump() for e in self.entries],
+            'gram_counts': self.gram_counts.tostring(),
+            'postings': dict((gram, ids.tostring()) for gram, ids in self.postings.iteritems())
+        }
+
+        tmp_file = index_file+'.tmp'
+        with open(tmp_file, 'wb') as f:
+            marshal.dump(data, f)
+        os.rename(tmp_file, index_file)
+
+    def _compact(self):
+        '''Renumbers users and rebuilds the postings, so removed ones don't take up space anymore.'''
+
+        entries = self.entries
+        self.entries = []
+        self.gram_counts = array('H')
+        self.user_ids = {}
+        self.postings = {}
+
+        for entry in entries:
+            if entry is not None:
+                self._index(entry)
@@ -0,0 +1,207 @@
+'''
+Thread-safe uoa_ldap client, backed by a pool of bound connections.
+
+Usage:
+
+    pool = uoa_ldap_pool(username, password, size=8)
+
+    # from any number of threads
+    entry = pool.find_upi('mbin029')
+
+    pool.close_ldap()
+
+Every query checks out a connection for the calling thread, so concurrent
+threads never share a connection. All queries of a thread (e.g. lookups in
+the loop over an iter_ldap generator) share its connection, which goes back
+to the pool when the last of them is finished. Connections that have been
+idle for a while are checked before they are handed out and rebound if dead.
+Queries that fail with a transient error (see uoa_ldap.TRANSIENT_ERRORS) are
+retried on a fresh connection, with exponential backoff; for iter_ldap, the
+paged search is started again and the entries that were already yielded are
+skipped. A connection that failed is never handed out again, but only unbound
+once no query of its thread uses it anymore.
+'''
+
+import time
+import threading
+import Queue
+from contextlib import contextmanager
+import ldap
+from uoa_ldap import uoa_ldap, connect, LDAPSERVER, PAGESIZE, TRANSIENT_ERRORS
+
+class uoa_ldap_pool(uoa_ldap):
+    '''uoa_ldap that can be shared between threads.'''
+
+    def __init__(self, username, password, url=LDAPSERVER, size=4, retries=3, backoff=0.5,
+                 idle_check=60, timeout=30, pagesize=PAGESIZE, connect=connect):
+        '''
+        size: maximum number of connections (threads block on checkout if they are all in use)
+        retries: how often failed binds and queries are retried
+        backoff: seconds to wait before the first retry, doubled for every further one
+        idle_check: connections that have been idle longer than this (in seconds) are checked before use
+        timeout: network and operation timeout for each connection, in seconds
+        pagesize: number of entries requested per page in paged searches
+        '''
+
+        self.username = username
+        self.password = password
+        self.url = url
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_check = idle_check
+        self.timeout = timeout
+        self.pagesize = pagesize
+        self.connect = connect
+
+        # the single connection of uoa_ldap is not used
+        self.ldap = None
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = Queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._closed = False
+
+        # bind one connection right away, so wrong credentials are reported early
+        self._checkin(self._checkout())
+
+    def _wait(self, attempt):
+
+        time.sleep(self.backoff * 2 ** attempt)
+
+    def _retry(self, attempt):
+
+        if attempt >= self.retries:
+            return False
+        self._wait(attempt)
+        return True
+
+    def _bind(self):
+        '''Returns a new bound connection, retrying transient errors.'''
+
+        attempt = 0
+        while True:
+            try:
+                conn = self.connect(self.username, self.password, self.url, timeout=self.timeout)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.retries:
+                    raise Exception('LDAP bind failed: %s' % e)
+                self._wait(attempt)
+                attempt += 1
+                continue
+
+            with self._lock:
+                self._connections.add(conn)
+            return conn
+
+    def _discard(self, conn):
+
+        with self._lock:
+            self._connections.discard(conn)
+        try:
+            conn.unbind()
+        except ldap.LDAPError:
+            pass
+
+    def _is_alive(self, conn):
+
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _checkout(self):
+
+        if self._closed:
+            raise Exception('Connection pool is closed.')
+
+        self._slots.acquire()
+        try:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except Queue.Empty:
+                return self._bind()
+
+            if time.time() - last_used > self.idle_check and not self._is_alive(conn):
+                self._discard(conn)
+                return self._bind()
+
+            return conn
+        except:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn, broken=False):
+
+        if broken or self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put((conn, time.time()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Provides the connection checked out by the current thread, checking one out if necessary.
+
+        The connection is checked in when the last user of this thread is finished. If it fails
+        with a transient error, later users of this thread get a fresh one.
+        '''
+
+        local = self._local
+        if not getattr(local, 'users', 0):
+            local.users = 0
+            local.conn = None
+            # connections that failed, but may still be used by other users of this thread
+            local.broken = []
+
+        if local.conn is None:
+            local.conn = self._checkout()
+
+        conn = local.conn
+        local.users += 1
+        try:
+            yield conn
+        except TRANSIENT_ERRORS:
+            if conn is local.conn:
+                # its slot is given back right away, so a retry can't block on a full pool
+                local.conn = None
+                local.broken.append(conn)
+                self._slots.release()
+            raise
+        finally:
+            local.users -= 1
+            if not local.users:
+                if local.conn is not None:
+                    self._checkin(local.conn)
+                    local.conn = None
+                for broken in local.broken:
+                    self._discard(broken)
+                local.broken = []
+
+    def _execute(self, operation):
+        '''Runs a query on a connection of this thread, retrying it on a fresh connection after transient errors.'''
+
+        attempt = 0
+        while True:
+            try:
+                with self.connection():
+                    return operation()
+            except TRANSIENT_ERRORS as e:
+                if not self._retry(attempt):
+                    raise Exception('LDAP query failed: %s' % e)
+                attempt += 1
+
+    def close_ldap(self):
+        '''Unbinds all connections. Connections that are checked out are unbound when they are returned.'''
+
+        self._closed = True
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(conn)
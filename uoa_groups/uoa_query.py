@@ -13,19 +13,27 @@ import getpass
 import os.path
 import ConfigParser
 from uoa_groups import UoA_groups
-from uoa_ldap import uoa_ldap
+from uoa_ldap import uoa_ldap, ROLE_GROUPS, SEARCHFILTER, extract_group_ids
+from uoa_snapshot import take_snapshot, SnapshotDiff
+from uoa_index import GroupIndex
+from uoa_people import PeopleIndex
+from uoa_reconcile import DepartmentResolver
+import uoa_complete
 import traceback
 import json
+import csv
 
 CONF_FOLDERNAME = 'uoa-groups'
 CONF_FILENAME = 'config'
 CONF_UOAGROUPS_FILENAME = 'departments.xlsx'
+CONF_PEOPLE_INDEX_FILENAME = 'people.idx'
 CONF_SYS = os.path.join('/etc/', CONF_FOLDERNAME)
 CONF_HOME = os.path.join(os.path.expanduser('~'), '.'+CONF_FOLDERNAME)
 CONF_SYS_CONFIG = os.path.join(CONF_SYS, CONF_FILENAME)
 CONF_SYS_UOAGROUPS = os.path.join(CONF_SYS, CONF_UOAGROUPS_FILENAME)
 CONF_HOME_CONFIG = os.path.join(CONF_HOME, CONF_FILENAME)
 CONF_HOME_UOAGROUPS = os.path.join(CONF_HOME, CONF_UOAGROUPS_FILENAME)
+CONF_HOME_PEOPLE_INDEX = os.path.join(CONF_HOME, CONF_PEOPLE_INDEX_FILENAME)
 
 # arg parsing ========================================
 class CliCommands(object):
@@ -50,9 +58,17 @@ class CliCommands(object):
         search_parser.add_argument('--groups', '-g', help="Display groups.", action='store_true')
         search_parser.add_argument('--roles', '-r', help="Display roles.", action='store_true')
         search_parser.add_argument('--department', '-d', help="Department entry in LDAP (beware, this is usually not very reliable)", action='store_true')
-        search_parser.add_argument('search', metavar='<search-term>', type=unicode, nargs=1, help='the search term')
+        search_parser.add_argument('--in-role', help="Only list people with this role (can be used more than once, people with any of the roles are listed).", action='append', choices=sorted(ROLE_GROUPS.keys()), default=[])
+        search_parser.add_argument('--in-unit', help="Only list people in this group or any group below it (can be used more than once).", action='append', default=[])
+        search_parser.add_argument('--local', '-l', help="Fuzzy search in the local people index instead of LDAP (create it with 'refresh-index').", action='store_true')
+        search_parser.add_argument('--limit', help="Maximum number of results for local searches (default: 20).", type=int, default=20)
+        search_parser.add_argument('search', metavar='<search-term>', type=unicode, nargs='*', help='the search term(s) (optional if --in-role or --in-unit is used)')
         search_parser.set_defaults(func=self.search, command='search')
 
+        refresh_index_parser = subparsers.add_parser('refresh-index', help='create or update the local people index')
+        refresh_index_parser.add_argument('--full', help="Re-fetch all entries, not only new and changed ones.", action='store_true')
+        refresh_index_parser.set_defaults(func=self.refresh_index, command='refresh-index')
+
 
         group_parser = subparsers.add_parser('group', help='group query')
         group_parser.add_argument('--id', help="Only query exact group id.", action='store_true')
@@ -64,6 +80,30 @@ class CliCommands(object):
         all_groups_parser.add_argument('--json', '-j', help='output in json format', action='store_true')
         all_groups_parser.set_defaults(func=self.all_groups, command='all-groups')
 
+        snapshot_parser = subparsers.add_parser('snapshot', help='write a snapshot of all unit and role memberships')
+        snapshot_parser.add_argument('snapshot_file', metavar='<snapshot-file>', nargs=1, help='the file to write the snapshot to')
+        snapshot_parser.set_defaults(func=self.snapshot, command='snapshot')
+
+        diff_parser = subparsers.add_parser('diff', help='display joiners, leavers and movers between two snapshots')
+        diff_parser.add_argument('--json', '-j', help='output in json format', action='store_true')
+        diff_parser.add_argument('old_snapshot', metavar='<old-snapshot>', nargs=1, help='the older snapshot file')
+        diff_parser.add_argument('new_snapshot', metavar='<new-snapshot>', nargs=1, help='the newer snapshot file')
+        diff_parser.set_defaults(func=self.diff, command='diff')
+
+        index_parser = subparsers.add_parser('index', help='build or query a local user/group index')
+        index_parser.add_argument('--rebuild', help="Rebuild the index from LDAP, even if the index file exists.", action='store_true')
+        index_parser.add_argument('--upi', '-u', help="Display the groups of this upi.", action='append', default=[])
+        index_parser.add_argument('--members', '-m', help="Display the members of this group id.", action='append', default=[])
+        index_parser.add_argument('--subtree', '-s', help="Include members of all sub-groups.", action='store_true')
+        index_parser.add_argument('index_file', metavar='<index-file>', nargs=1, help='the index file (will be created if it does not exist)')
+        index_parser.set_defaults(func=self.index, command='index')
+
+        reconcile_parser = subparsers.add_parser('reconcile', help='map the department entries of all active users to groups')
+        reconcile_parser.add_argument('--min-confidence', help="Minimum confidence (0 to 1) of a match (default: 0.5).", type=float, default=0.5)
+        reconcile_parser.add_argument('--output', '-o', help="Write upi, department, group id and confidence of every user to this csv file.")
+        reconcile_parser.add_argument('--report', '-r', help="Write all department entries that couldn't be mapped to this csv file.")
+        reconcile_parser.set_defaults(func=self.reconcile, command='reconcile')
+
         self.namespace = parser.parse_args()
 
         try:
@@ -152,29 +192,212 @@ class CliCommands(object):
         if not ldap_password:
             ldap_password = getpass.getpass()
 
-        ldap = uoa_ldap(ldap_user, ldap_password)
+        try:
+            ldap = uoa_ldap(ldap_user, ldap_password)
+        except Exception as e:
+            print e
+            sys.exit(1)
+
         return ldap
 
 
     def search(self, args):
 
-        ldap = self.get_ldap()
+        if not args.search and not args.in_role and not args.in_unit:
+            print "No search term, role or unit specified, exiting..."
+            sys.exit(0)
+
+        search_term = u' '.join(args.search).encode('utf-8') or None
 
-        users = ldap.search_user("*"+args.search[0]+"*")
+        if args.local:
+            users = self.search_local(search_term, args.in_role, args.in_unit, args.limit)
+        else:
+            ldap = self.get_ldap()
+            results = ldap.search_people(self.config.uoa_groups, search_term, args.in_role, args.in_unit)
+            users = [results[dn] for dn in sorted(results)]
 
+        resolver = DepartmentResolver(self.config.uoa_groups) if args.department else None
         for u in users:
 
-            res = researcher.from_ldap_entry(u[0][1], self.config.uoa_groups)
+            res = researcher.from_ldap_entry(u, self.config.uoa_groups, resolver)
             pretty_print_researcher(res, args.roles, args.groups, args.department)
             print "        -----------           "
 
         print ""
 
+    def search_local(self, search_term, roles, units, limit):
+
+        if not os.path.exists(CONF_HOME_PEOPLE_INDEX):
+            print "No local people index, create it with: uoa-groups refresh-index"
+            sys.exit(1)
+
+        index = PeopleIndex.load(CONF_HOME_PEOPLE_INDEX)
+
+        role_dns = [ROLE_GROUPS[r] for r in roles]
+        unit_gids = set()
+        for gid in units:
+            group = self.config.uoa_groups.get_group(gid, True)
+            if not group:
+                raise Exception("No group with id: "+str(gid))
+            unit_gids.update(g.gid for g in group.get_subtree())
+
+        def matches(entry):
+            memberships = entry.get('memberOf') or []
+            if role_dns and not any(dn in memberships for dn in role_dns):
+                return False
+            if unit_gids and not unit_gids.intersection(extract_group_ids(memberships)):
+                return False
+            return True
+
+        if search_term:
+            # when filtering, rank all matches, so filtered out entries don't take up places
+            ranked = len(index) if role_dns or unit_gids else limit
+            candidates = [entry for score, entry in index.search(search_term, limit=ranked)]
+        else:
+            candidates = (index.get(upi) for upi in sorted(index.user_ids))
+
+        users = []
+        for entry in candidates:
+            if len(users) >= limit:
+                break
+            if matches(entry):
+                users.append(entry)
+
+        return users
+
+    def refresh_index(self, args):
+
+        if os.path.exists(CONF_HOME_PEOPLE_INDEX) and not args.full:
+            index = PeopleIndex.load(CONF_HOME_PEOPLE_INDEX)
+        else:
+            index = PeopleIndex()
+
+        ldap = self.get_ldap()
+        updated, removed = index.refresh(ldap, args.full)
+        ldap.close_ldap()
+
+        if not os.path.exists(CONF_HOME):
+            os.makedirs(CONF_HOME)
+        index.save(CONF_HOME_PEOPLE_INDEX)
+        print "Updated {} and removed {} entries, {} people in: {}".format(updated, removed, len(index), CONF_HOME_PEOPLE_INDEX)
+
+    def snapshot(self, args):
+
+        ldap = self.get_ldap()
+
+        users = take_snapshot(ldap, self.config.uoa_groups, args.snapshot_file[0])
+        ldap.close_ldap()
+
+        print "Wrote memberships of {} users to: {}".format(users, args.snapshot_file[0])
+
+    def diff(self, args):
+
+        diff = SnapshotDiff.from_files(args.old_snapshot[0], args.new_snapshot[0])
+
+        if args.json:
+            print json.dumps(diff.to_dict(), indent=2, sort_keys=True)
+            return
+
+        print ""
+        if diff.is_empty():
+            print "No changes."
+            print ""
+            return
+
+        for key in sorted(set(diff.joiners.keys() + diff.leavers.keys())):
+            print key
+            for upi in diff.joiners.get(key, []):
+                print "\t+ "+upi
+            for upi in diff.leavers.get(key, []):
+                print "\t- "+upi
+
+        movers = diff.movers()
+        if movers:
+            print ""
+            print "Movers:"
+            for upi, left, joined in movers:
+                print "\t{}: {} -> {}".format(upi, ", ".join(left), ", ".join(joined))
+
+        print ""
+
+    def index(self, args):
+
+        index_file = args.index_file[0]
+
+        if args.rebuild or not os.path.exists(index_file):
+            ldap = self.get_ldap()
+            index = GroupIndex.build(ldap, self.config.uoa_groups)
+            ldap.close_ldap()
+            index.save(index_file)
+            print "Indexed {} users and {} groups to: {}".format(len(index.upis), len(index.gids), index_file)
+        else:
+            index = GroupIndex.load(index_file)
+
+        for upi in args.upi:
+            print ""
+            groups = index.groups_of(upi)
+            if groups is None:
+                print upi+": not indexed"
+                continue
+            print upi+":"
+            for gid in groups:
+                print "\t"+str(self.config.uoa_groups.get_group(gid) or gid)
+
+        for gid in args.members:
+            print ""
+            members = index.users_of(gid, args.subtree)
+            if members is None:
+                print gid+": no such group"
+                continue
+            print "{} ({} members):".format(gid, len(members))
+            for upi in members:
+                print "\t"+upi
+
+        print ""
+
+    def reconcile(self, args):
+
+        ldap = self.get_ldap()
+        resolver = DepartmentResolver(self.config.uoa_groups, args.min_confidence)
+
+        entries = list(ldap.iter_ldap(SEARCHFILTER, ['cn', 'department']))
+        resolved, unmatched = resolver.resolve_all(entries)
+
+        departments = {}
+        for dn, attrs in entries:
+            if dn:
+                departments[attrs['cn'][0]] = (attrs.get('department') or [''])[0]
+
+        matched = len(resolved) - sum(len(upis) for upis in unmatched.itervalues())
+        print "Mapped {} of {} users to a group, {} distinct department entries couldn't be mapped.".format(matched, len(resolved), len(unmatched))
+
+        if args.output:
+            with open(args.output, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['upi', 'department', 'group', 'confidence'])
+                for upi in sorted(resolved):
+                    gid, confidence = resolved[upi]
+                    writer.writerow([upi, departments[upi], gid or '', '{:.2f}'.format(confidence)])
+            print "Mappings written to: "+args.output
+
+        if args.report:
+            resolver.write_unmatched_report(unmatched, args.report)
+            print "Unmatched department entries written to: "+args.report
+        else:
+            for department, upis in sorted(unmatched.iteritems(), key=lambda item: -len(item[1]))[:20]:
+                print "\t{} ({} users)".format(department, len(upis))
+
     def upi(self, args):
 
         ldap = self.get_ldap()
 
-        user = researcher.from_upi(args.upi[0], self.config.uoa_groups, ldap)
+        resolver = DepartmentResolver(self.config.uoa_groups) if args.department else None
+        user = researcher.from_upi(args.upi[0], self.config.uoa_groups, ldap, resolver)
+
+        try:
+            uoa_complete.remember_upi(args.upi[0])
+        except (IOError, OSError) as e:
+            logging.warning("Could not update recently used upis: "+str(e))
 
         pretty_print_researcher(user, args.roles, args.groups, args.department)
 
@@ -192,6 +415,12 @@ class ProjectConfig(object):
 
         self.uoa_groups = UoA_groups(self.uoagroups_file)
 
+        # keep the shell completion data in sync with the groups file
+        try:
+            uoa_complete.refresh_group_table(self.uoa_groups)
+        except (IOError, OSError) as e:
+            logging.warning("Could not update completion data: "+str(e))
+
         config = ConfigParser.SafeConfigParser()
 
         try:
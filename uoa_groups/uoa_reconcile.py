@@ -0,0 +1,298 @@
+'''
+Maps the free-text LDAP department attribute to groups of the UoA hierarchy.
+
+The department attribute is typed in by hand, so the same unit shows up as
+'Dept of Mathematics', 'Mathematics Department', 'MATHEMATICS' or
+'Mathematics & Statistics'. DepartmentResolver precomputes an index over the
+names (and ids) of all groups, with names normalized (case, accents,
+punctuation, abbreviations like 'Dept', and filler words like 'of' or
+'Faculty' removed), and resolves department strings in this order:
+
+ - exact group id, or exact normalized name: confidence 1.0
+ - same set of name words, in any order: confidence 0.9
+ - best overlap of name words (Dice coefficient, words of at least 4
+   characters also match as a prefix, like 'Chem'): confidence 0.8 * overlap
+
+A match that's shared by several groups has its confidence halved. Results are
+memoized per department string, so a whole population (which only has a
+few thousand distinct department strings) is resolved in one cheap pass.
+When the hierarchy is reloaded, only the memoized results that the changed
+groups can affect are dropped.
+'''
+
+import csv
+import weakref
+from uoa_people import fold
+
+# the confidence of a match that is shared by more than one group is multiplied by this
+AMBIGUOUS_PENALTY = 0.5
+
+MIN_CONFIDENCE = 0.5
+
+# shorter words only match whole words
+MIN_PREFIX_LENGTH = 4
+
+ABBREVIATIONS = {
+    'dept': 'department',
+    'dep': 'department',
+    'depart': 'department',
+    'fac': 'faculty',
+    'sch': 'school',
+    'inst': 'institute',
+    'ctr': 'centre',
+    'cntr': 'centre',
+    'center': 'centre',
+    'univ': 'university',
+    'uni': 'university',
+    'mgmt': 'management',
+    'admin': 'administration',
+    'eng': 'engineering',
+    'sci': 'science',
+    'sciences': 'science',
+    'studies': 'study',
+    'stats': 'statistics',
+    'maths': 'mathematics',
+    'med': 'medical',
+}
+
+# dropped from normalized names
+STOP_WORDS = frozenset(['of', 'the', 'and', 'for', 'in', 'a', 'an', 'at'])
+
+# dropped for word set matching, since most group names contain one of them
+UNIT_WORDS = frozenset(['department', 'faculty', 'school', 'unit', 'office', 'division', 'university', 'auckland'])
+
+def normalize(text):
+    '''Returns the normalized words of a group name or department string.'''
+
+    words = []
+    for word in fold(text or u'').split():
+        word = ABBREVIATIONS.get(word, word)
+        if word not in STOP_WORDS:
+            words.append(word)
+
+    return words
+
+def core_words(words):
+    '''Returns the set of words used for word set matching.'''
+
+    core = frozenset(w for w in words if w not in UNIT_WORDS)
+    # a name that consists only of unit words, e.g. 'School Office'
+    return core or frozenset(words)
+
+class DepartmentResolver(object):
+    '''
+    Resolves department strings to group ids of a UoA_groups hierarchy.
+
+    Whenever the hierarchy is reloaded (until close is called), the index is rebuilt if groups were
+    added, removed or renamed (that takes tens of milliseconds for thousands of groups), and the
+    memoized results the changes can affect are dropped. The hierarchy only keeps a weak reference
+    to the resolver.
+    '''
+
+    def __init__(self, uoa_groups, min_confidence=MIN_CONFIDENCE):
+
+        self.uoa_groups = uoa_groups
+        self.min_confidence = min_confidence
+        self._state = (self._build(), {})
+
+        resolver = weakref.ref(self)
+
+        def rebuild(groups, diff):
+            r = resolver()
+            if r is None:
+                groups.remove_listener(rebuild)
+            else:
+                r._update(diff)
+
+        self._listener = rebuild
+        uoa_groups.add_listener(rebuild)
+
+    def close(self):
+        '''Stops rebuilding the index when the hierarchy is reloaded.'''
+
+        self.uoa_groups.remove_listener(self._listener)
+
+    def _build(self):
+        '''Returns the index over the current hierarchy.'''
+
+        ids = {}
+        names = {}
+        word_sets = {}
+        postings = {}
+        prefixes = {}
+        cores = {}
+
+        for group in self.uoa_groups.root.get_subtree():
+            gid = group.gid
+            ids.setdefault(fold(gid), set()).add(gid)
+
+            words = normalize(group.name)
+            if not words:
+                continue
+            names.setdefault(u' '.join(words), set()).add(gid)
+
+            core = core_words(words)
+            cores[gid] = core
+            word_sets.setdefault(core, set()).add(gid)
+            # (group id, word) pairs, so a word of a group name is only counted once when scoring
+            for word in core:
+                postings.setdefault(word, set()).add((gid, word))
+                for i in xrange(MIN_PREFIX_LENGTH, len(word)):
+                    prefixes.setdefault(word[:i], set()).add((gid, word))
+
+        return ids, names, word_sets, postings, prefixes, cores
+
+    def _update(self, diff):
+        '''Brings the index up to date after a reload, keeps the memoized results the GroupsDiff can't affect.'''
+
+        old_index, old_cache = self._state
+        changed = diff.added | diff.removed | set(diff.renamed)
+        # the index only depends on ids and names, not on where groups are in the hierarchy
+        index = self._build() if changed else old_index
+
+        # a result can only change if the department string matches the id of a changed group,
+        # or shares a word (or prefix) with its old or new name
+        changed_ids = set(fold(gid) for gid in changed)
+        changed_words = set()
+        for cores in (old_index[5], index[5]):
+            for gid in changed:
+                changed_words.update(cores.get(gid, ()))
+
+        def affected(department, tied):
+            # equally good matches are picked by their depth in the hierarchy
+            if tied and diff.reparented:
+                return True
+            if fold(department or u'') in changed_ids:
+                return True
+            for word in core_words(normalize(department)):
+                if word in changed_words:
+                    return True
+                if len(word) >= MIN_PREFIX_LENGTH and any(w.startswith(word) for w in changed_words):
+                    return True
+            return False
+
+        cache = dict((department, result) for department, result in old_cache.items() if not affected(department, result[2]))
+
+        # index and memoized results are swapped in together, like the hierarchy itself,
+        # so results computed with an old index never end up in the new cache
+        self._state = (index, cache)
+
+    def resolve(self, department):
+        '''Returns (group id, confidence) for a department string, or (None, 0.0) if nothing matches well enough.'''
+
+        index, cache = self._state
+        try:
+            gid, confidence, tied = cache[department]
+            return gid, confidence
+        except KeyError:
+            pass
+
+        gid, confidence, tied = self._resolve(index, department)
+        if confidence < self.min_confidence:
+            gid, confidence = None, 0.0
+
+        # (group id, confidence, whether it was picked from several equally good matches)
+        cache[department] = (gid, confidence, tied)
+        return gid, confidence
+
+    def resolve_group(self, department):
+        '''Returns (UoA_group, confidence) for a department string, or (None, 0.0).'''
+
+        gid, confidence = self.resolve(department)
+        if gid is None:
+            return None, 0.0
+        return self.uoa_groups.get_group(gid), confidence
+
+    def _resolve(self, index, department):
+        '''Returns (group id, confidence, tied) for the best match, see _pick.'''
+
+        ids, names, word_sets, postings, prefixes, cores = index
+
+        folded = fold(department or u'')
+        if folded in ids:
+            return self._pick(ids[folded], 1.0)
+
+        words = normalize(department)
+        if not words:
+            return None, 0.0, False
+
+        key = u' '.join(words)
+        if key in names:
+            return self._pick(names[key], 1.0)
+
+        core = core_words(words)
+        if core in word_sets:
+            return self._pick(word_sets[core], 0.9)
+
+        # only groups that share at least one word are candidates
+        shared = {}
+        for word in core:
+            for gid, group_word in postings.get(word, set()).union(prefixes.get(word, ())):
+                department_words, group_words = shared.setdefault(gid, (set(), set()))
+                department_words.add(word)
+                group_words.add(group_word)
+        if not shared:
+            return None, 0.0, False
+
+        # several department words can match the same word of a name (as prefixes) and the
+        # other way round, so count each word on either side only once (scores stay <= 1)
+        scores = dict((gid, 2.0 * min(len(department_words), len(group_words)) / (len(core) + len(cores[gid])))
+                      for gid, (department_words, group_words) in shared.iteritems())
+        best = max(scores.itervalues())
+        return self._pick([gid for gid, score in scores.iteritems() if score == best], 0.8 * best)
+
+    def _pick(self, gids, confidence):
+        '''
+        Picks one of several equally good matches (the one highest up in the hierarchy), and lowers the confidence.
+
+        Returns (group id, confidence, tied), tied is True if there was more than one match.
+        '''
+
+        if len(gids) == 1:
+            return iter(gids).next(), confidence, False
+
+        root = self.uoa_groups.root
+
+        def depth(gid):
+            group = root.get_child(gid, False)
+            d = 0
+            while group and group.parent:
+                group = group.parent
+                d += 1
+            return d
+
+        return min(gids, key=lambda gid: (depth(gid), gid)), confidence * AMBIGUOUS_PENALTY, True
+
+    def resolve_all(self, entries):
+        '''
+        Resolves the department of every entry (an iterable of (dn, attrs) tuples, or a dict with dns as keys).
+
+        Returns a dict with (group id, confidence) per upi, and a dict with the list of upis per
+        department string that couldn't be resolved.
+        '''
+
+        if isinstance(entries, dict):
+            entries = entries.iteritems()
+
+        resolved = {}
+        unmatched = {}
+        for dn, attrs in entries:
+            if not dn:
+                continue
+            upi = attrs['cn'][0]
+            departments = attrs.get('department') or ['']
+            gid, confidence = self.resolve(departments[0])
+            resolved[upi] = (gid, confidence)
+            if gid is None:
+                unmatched.setdefault(departments[0], []).append(upi)
+
+        return resolved, unmatched
+
+    def write_unmatched_report(self, unmatched, report_file):
+        '''Writes a csv file with all unresolved department strings, the ones with the most users first.'''
+
+        with open(report_file, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['department', 'users', 'example upis'])
+            for department, upis in sorted(unmatched.iteritems(), key=lambda item: (-len(item[1]), item[0])):
+                writer.writerow([department, len(upis), ' '.join(sorted(upis)[:5])])
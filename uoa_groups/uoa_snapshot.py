@@ -0,0 +1,167 @@
+'''
+Membership snapshots of the UoA hierarchy units and role groups, and the
+differences (joiners, leavers, movers) between two of them.
+
+A snapshot is a gzipped text file with one line per membership, sorted by
+group key first and upi second:
+
+    role:staff<TAB>abcd001
+    unit:CHEM<TAB>abcd001
+
+Unit keys are the group ids of the '.uos' groups a user is a direct member
+of (only ids that exist in the hierarchy are kept), role keys are the names
+in uoa_ldap.ROLE_GROUPS. Since both snapshots are sorted the same way, they
+can be compared with a single linear merge that streams both files.
+'''
+
+import os
+import gzip
+from blist import sortedset
+from uoa_ldap import SEARCHFILTER, ROLE_GROUPS, extract_group_ids
+
+SNAPSHOT_HEADER = '# uoa-groups membership snapshot v1'
+UNIT_PREFIX = 'unit:'
+ROLE_PREFIX = 'role:'
+
+def membership_keys(memberships, group_ids):
+    '''Returns the snapshot keys (units and roles) for a list of memberOf DNs, group_ids is the set of all ids in the hierarchy.'''
+
+    if not memberships:
+        return []
+
+    keys = [UNIT_PREFIX+gid for gid in extract_group_ids(memberships) if gid in group_ids]
+
+    memberships = set(memberships)
+    keys.extend(ROLE_PREFIX+role for role, dn in ROLE_GROUPS.iteritems() if dn in memberships)
+
+    return keys
+
+def take_snapshot(ldap, uoa_groups, snapshot_file, searchfilter=SEARCHFILTER):
+    '''
+    Pulls the memberships of all users matching the searchfilter and writes them to a snapshot file.
+
+    Returns the number of users in the snapshot.
+    '''
+
+    # looked up for every membership, so don't walk the hierarchy each time
+    group_ids = set(group.gid for group in uoa_groups.root.get_subtree())
+
+    members = {}
+    users = 0
+    for dn, attrs in ldap.iter_ldap(searchfilter, ['cn', 'memberOf']):
+        if not dn:
+            # referral
+            continue
+        users += 1
+        upi = intern(attrs['cn'][0])
+        for key in membership_keys(attrs.get('memberOf'), group_ids):
+            members.setdefault(key, sortedset()).add(upi)
+
+    write_snapshot(members, snapshot_file)
+    return users
+
+def write_snapshot(members, snapshot_file):
+    '''Writes a dict of (key, sorted upis) to a snapshot file, replacing it atomically.'''
+
+    tmp_file = snapshot_file+'.tmp'
+    with gzip.open(tmp_file, 'wb') as f:
+        f.write(SNAPSHOT_HEADER+'\n')
+        for key in sorted(members):
+            for upi in members[key]:
+                f.write(key+'\t'+upi+'\n')
+
+    os.rename(tmp_file, snapshot_file)
+
+def read_snapshot(snapshot_file):
+    '''Generator that yields the (key, upi) tuples of a snapshot file, in sorted order.'''
+
+    with gzip.open(snapshot_file, 'rb') as f:
+        first = f.readline().rstrip('\n')
+        if first != SNAPSHOT_HEADER:
+            raise Exception("Not a snapshot file: "+str(snapshot_file))
+
+        for line in f:
+            key, upi = line.rstrip('\n').split('\t')
+            yield key, upi
+
+def merge_snapshots(old, new):
+    '''
+    Linear merge of two sorted (key, upi) iterables.
+
+    Yields (key, upi, -1) for records that are only in old, and (key, upi, 1) for records only in new.
+    '''
+
+    old = iter(old)
+    new = iter(new)
+    o = next(old, None)
+    n = next(new, None)
+
+    while o is not None or n is not None:
+        if n is None or (o is not None and o < n):
+            yield o[0], o[1], -1
+            o = next(old, None)
+        elif o is None or n < o:
+            yield n[0], n[1], 1
+            n = next(new, None)
+        else:
+            o = next(old, None)
+            n = next(new, None)
+
+class SnapshotDiff(object):
+    '''
+    The changes between two snapshots.
+
+    joiners and leavers map snapshot keys (e.g. 'unit:CHEM', 'role:staff') to sorted lists of upis.
+    '''
+
+    def __init__(self):
+        self.joiners = {}
+        self.leavers = {}
+
+    @classmethod
+    def from_files(cls, old_snapshot_file, new_snapshot_file):
+        '''Computes the diff between two snapshot files.'''
+
+        diff = cls()
+        for key, upi, change in merge_snapshots(read_snapshot(old_snapshot_file), read_snapshot(new_snapshot_file)):
+            if change > 0:
+                diff.joiners.setdefault(key, []).append(upi)
+            else:
+                diff.leavers.setdefault(key, []).append(upi)
+
+        return diff
+
+    def is_empty(self):
+        return not self.joiners and not self.leavers
+
+    def movers(self):
+        '''
+        Returns a sorted list of (upi, left_units, joined_units) for all users that left one or
+        more units and joined one or more others.
+        '''
+
+        left = self._units_by_upi(self.leavers)
+        joined = self._units_by_upi(self.joiners)
+
+        return [(upi, left[upi], joined[upi]) for upi in sorted(left) if upi in joined]
+
+    def _units_by_upi(self, changes):
+
+        units = {}
+        for key in sorted(changes):
+            if not key.startswith(UNIT_PREFIX):
+                continue
+            gid = key[len(UNIT_PREFIX):]
+            for upi in changes[key]:
+                units.setdefault(upi, []).append(gid)
+
+        return units
+
+    def to_dict(self):
+        '''Returns a json-serializable representation of this diff.'''
+
+        return {
+            'joiners': self.joiners,
+            'leavers': self.leavers,
+            'movers': [{'upi': upi, 'from': left, 'to': joined} for upi, left, joined in self.movers()]
+        }